@@ -0,0 +1,109 @@
+"""
+Text analysis of the keyword index - the same for indexed articles and for keywords of queries
+
+Text is split into words, each word is normalized (case, accents, punctuation within it: U.S., don't),
+stopwords are dropped and the rest is reduced by light suffix stripping to a term:
+watch, watches, watched and watching are all indexed and looked up as "watch".
+Terms of distinct words are memoized, so analysis of a text is mostly lookups of its words
+"""
+import functools
+import re
+import unicodedata
+
+# lengths of indexed terms - the longest one is limited by Keyword.name
+MIN_LENGTH = 3
+MAX_LENGTH = 255
+
+# apostrophes and dots are parts of words, other non-word characters separate them
+WORD = re.compile(r"[\w'’.]+")
+PUNCTUATION = re.compile(r"[_'’.]+")
+VOWELS = frozenset('aeiouy')
+
+STOPWORDS = frozenset("""
+    a about above after again against all also am an and any are aren't as at be because been before being below
+    between both but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each few
+    for from further get gets got had hadn't has hasn't have haven't having he he'd he'll he's her here here's hers
+    herself him himself his how how's i i'd i'll i'm i've if in into is isn't it it's its itself just let's me more
+    most mustn't my myself no nor not now of off on once one only or other ought our ours ourselves out over own
+    said same say says shan't she she'd she'll she's should shouldn't so some such than that that's the their theirs
+    them themselves then there there's these they they'd they'll they're they've this those through to too under
+    until up us very was wasn't we we'd we'll we're we've were weren't what what's when when's where where's which
+    while who who's whom why why's will with won't would wouldn't you you'd you'll you're you've your yours yourself
+    yourselves
+""".replace("'", '').split())
+
+
+def normalize(word):
+    """
+    :return str: lower case word without accents and punctuation
+    """
+    word = PUNCTUATION.sub('', word).lower()
+    if not word.isascii():
+        word = ''.join(x for x in unicodedata.normalize('NFKD', word) if not unicodedata.combining(x))
+    return word
+
+
+def _strip(word, suffix):
+    """
+    :return str: word without the suffix (undoubled: running -> run) if a syllable is left, None otherwise
+    """
+    base = word[:-len(suffix)]
+    if len(base) < MIN_LENGTH or not VOWELS & set(base):
+        return None
+    if base[-1] == base[-2] and base[-1] not in VOWELS and base[-1] not in 'lsz':
+        base = base[:-1]
+    return base
+
+
+def stem(word):
+    """
+    Light stemming - plurals and -ed/-ing forms of English words, other words are kept as is
+    """
+    if not word.isalpha() or len(word) <= 4:
+        return word
+    if word.endswith(('ies', 'ied')):
+        return word[:-3] + 'y'
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith('es') and word[:-2].endswith(('s', 'x', 'z', 'ch', 'sh')):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    if word.endswith('ing'):
+        return _strip(word, 'ing') or word
+    if word.endswith('ed') and not word.endswith('eed'):
+        return _strip(word, 'ed') or word
+    return word
+
+
+@functools.lru_cache(maxsize=100000)
+def get_term(word):
+    """
+    :return str: indexed term of the word, None for stopwords and words out of the lengths
+    """
+    word = normalize(word)
+    if word in STOPWORDS:
+        return None
+    word = stem(word)
+    if not MIN_LENGTH <= len(word) <= MAX_LENGTH:
+        return None
+    return word
+
+
+def analyze(*texts):
+    """
+    :return set: terms of the texts
+    """
+    terms = {get_term(word) for text in texts for word in WORD.findall(str(text))}
+    terms.discard(None)
+    return terms
+
+
+def analyze_rows(rows):
+    """
+    Terms of texts of a batch of rows - e.g. in worker processes, it needs no database
+
+    :param rows: iterable of (id, *texts)
+    :return dict: id -> set of terms
+    """
+    return {pk: analyze(*texts) for pk, *texts in rows}
@@ -0,0 +1,252 @@
+"""
+Benchmarks of the read and ingest paths on a synthetic corpus
+
+Corpus is generated from a seed, so runs with the same parameters are comparable:
+words of titles and descriptions and authors follow Zipf distribution like in real news.
+Every scenario is measured by latency of whole requests and by number of SQL queries
+"""
+import contextlib
+import datetime
+import http.server
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.parse
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from news.management.commands import get_articles_from_newsapi
+from news.management.commands.import_articles import batched, import_batch
+from news.pagination import ArticlePagination
+
+ZIPF_EXPONENT = 1.1
+VOCABULARY_SIZE = 20000
+AUTHORS = 2000
+DAYS = 365
+TITLE_WORDS = 8
+DESCRIPTION_WORDS = 25
+SEED_BATCH_SIZE = 10000
+
+# relative slowdown of median latency counted as regression and minimal absolute one (noise of small timings)
+THRESHOLD = 0.2
+MIN_DELTA_MS = 2
+
+
+class NewsApiStub(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in of newsapi.org: replies with queued (status, headers, payload),
+    when the queue is empty - with the requested page of server.articles
+    """
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.server.requests.append(params)
+        if self.server.responses:
+            status, headers, payload = self.server.responses.pop(0)
+        else:
+            page, page_size = int(params.get('page', 1)), int(params.get('pageSize', 100))
+            articles = self.server.articles[(page - 1) * page_size:page * page_size]
+            status, headers, payload = 200, {}, {
+                'status': 'ok', 'totalResults': len(self.server.articles), 'articles': articles
+            }
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def news_api_stub(articles=()):
+    """
+    Runs NewsApiStub in a thread, server.url is the URL of its /v2/everything
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), NewsApiStub)
+    server.requests = []
+    server.responses = []
+    server.articles = list(articles)
+    server.url = f'http://127.0.0.1:{server.server_port}/v2/everything'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class Corpus:
+    """
+    Generator of articles in the format of newsapi.org
+    Word of rank r (and author of rank r) occurs with probability proportional to 1 / r ** ZIPF_EXPONENT
+    """
+
+    def __init__(self, seed=0, vocabulary_size=VOCABULARY_SIZE, authors=AUTHORS, days=DAYS):
+        self.seed = seed
+        self.words = [self.word(rank) for rank in range(vocabulary_size)]
+        self.authors = [f'{self.word(rank).title()} {self.word(rank + 1).title()}' for rank in range(authors)]
+        self.word_weights = self.zipf_weights(vocabulary_size)
+        self.author_weights = self.zipf_weights(authors)
+        self.end = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+        self.start = self.end - datetime.timedelta(days=days)
+
+    @staticmethod
+    def word(rank):
+        """
+        Pronounceable word, unique per rank and long enough to become a keyword
+        """
+        syllables = []
+        for _ in range(3):
+            rank, syllable = divmod(rank, 100)
+            syllables.append('bdfgklmnprstvz'[syllable % 14] + 'aeiou'[syllable // 20] + 'nrs'[syllable % 3])
+        return ''.join(syllables)
+
+    @staticmethod
+    def zipf_weights(size):
+        return list(itertools.accumulate(1 / rank ** ZIPF_EXPONENT for rank in range(1, size + 1)))
+
+    def articles(self, count, prefix='corpus'):
+        """
+        :param prefix: part of URLs - corpora with different prefixes do not overlap
+        """
+        rnd = random.Random(f'{self.seed}-{prefix}')
+        span = (self.end - self.start).total_seconds()
+        for i in range(count):
+            words = rnd.choices(self.words, cum_weights=self.word_weights, k=TITLE_WORDS + DESCRIPTION_WORDS)
+            published = self.start + datetime.timedelta(seconds=int(rnd.random() * span))
+            yield {
+                'author': rnd.choices(self.authors, cum_weights=self.author_weights)[0],
+                'title': ' '.join(words[:TITLE_WORDS]).capitalize(),
+                'description': ' '.join(words[TITLE_WORDS:]).capitalize() + '.',
+                'url': f'https://news.example.com/{prefix}/{i}',
+                'urlToImage': f'https://news.example.com/{prefix}/{i}.jpg',
+                'publishedAt': published.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'content': '',
+            }
+
+    def load(self, count, batch_size=SEED_BATCH_SIZE):
+        """
+        Loads the corpus into DB the fastest way - like import_articles command
+        """
+        for batch in batched(self.articles(count), batch_size):
+            import_batch(batch)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE news_article, news_author, news_keyword, news_article_keywords')
+
+
+def measure(func, repeat):
+    """
+    Runs the function once to warm up and `repeat` times more
+    :return dict: number of queries of one run, median and 95th percentile of latency in ms
+    """
+    func(0)
+    timings = []
+    for i in range(1, repeat + 1):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func(i)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'queries': len(queries.captured_queries),
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, round(0.95 * (len(timings) - 1)))], 3),
+    }
+
+
+def get_scenarios(corpus, size, ingest_size, stub):
+    """
+    :return dict: name of scenario - function of the run number
+    """
+    client = Client()
+    list_url = reverse('articles-list')
+    middle = corpus.start + (corpus.end - corpus.start) / 2
+    deep = ArticlePagination().encode_cursor((corpus.start + (corpus.end - corpus.start) / 10, 0))
+
+    def get(**params):
+        def run(i):
+            response = client.get(list_url, params)
+            if response.status_code != 200:  # pragma: no cover
+                raise RuntimeError(f'{list_url} {params} responded {response.status_code}: {response.content}')
+        return run
+
+    # ingested articles must be new to the database even if it holds a corpus of previous runs
+    run_id = time.time_ns()
+
+    def ingest(i):
+        stub.articles = list(corpus.articles(ingest_size, prefix=f'ingest-{run_id}-{i}'))
+        new_articles = get_articles_from_newsapi.download_articles(f'benchmark-{run_id}-{i}', 1)
+        if len(new_articles) != ingest_size:  # pragma: no cover
+            raise RuntimeError(f'{len(new_articles)} articles ingested instead of {ingest_size}')
+
+    return {
+        'list': get(),
+        'list_estimate_count': get(count='estimate'),
+        'keywords_all': get(keywords=f'{corpus.words[0]},{corpus.words[1]}'),
+        'keywords_any': get(keywords=f'{corpus.words[10]},{corpus.words[100]}', keywords_mode='any'),
+        'search': get(search=f'{corpus.words[5]} {corpus.words[50]}'),
+        'date_range': get(from_date=middle.strftime('%Y-%m-%d'),
+                          to_date=(middle + datetime.timedelta(days=7)).strftime('%Y-%m-%d')),
+        'deep_offset': get(offset=max(0, size - 100)),
+        'deep_cursor': get(cursor=deep),
+        'ingest': ingest,
+    }
+
+
+def run(size, seed=0, repeat=5, ingest_size=500):
+    """
+    Loads the corpus of `size` articles into the current database and measures all scenarios
+    :return dict: parameters of the run in "meta" and measurements in "scenarios"
+    """
+    corpus = Corpus(seed)
+    start = time.perf_counter()
+    corpus.load(size)
+    load_time = time.perf_counter() - start
+
+    rate_limiter = get_articles_from_newsapi.rate_limiter
+    get_articles_from_newsapi.rate_limiter = None   # only the stub is called
+    try:
+        with news_api_stub() as stub:
+            # images of the corpus do not exist
+            with override_settings(NEWS_API_URL=stub.url, NEWS_CACHE_TIMEOUT=0, NEWS_IMAGE_CACHE=False,
+                                   ALLOWED_HOSTS=['*']):
+                scenarios = {
+                    name: measure(func, repeat)
+                    for name, func in get_scenarios(corpus, size, ingest_size, stub).items()
+                }
+    finally:
+        get_articles_from_newsapi.rate_limiter = rate_limiter
+
+    return {
+        'meta': {'size': size, 'seed': seed, 'repeat': repeat, 'ingest_size': ingest_size,
+                 'load_rows_per_second': round(size / max(load_time, 1e-9))},
+        'scenarios': scenarios,
+    }
+
+
+def compare(results, baseline, threshold=THRESHOLD, min_delta_ms=MIN_DELTA_MS):
+    """
+    :return list: descriptions of regressions - more queries or median latency slower than by threshold
+    """
+    regressions = []
+    for name, expected in baseline['scenarios'].items():
+        actual = results['scenarios'].get(name)
+        if actual is None:
+            continue
+        if actual['queries'] > expected['queries']:
+            regressions.append(f'{name}: {actual["queries"]} queries instead of {expected["queries"]}')
+        delta = actual['median_ms'] - expected['median_ms']
+        if delta > expected['median_ms'] * threshold and delta > min_delta_ms:
+            regressions.append(f'{name}: median {actual["median_ms"]:.1f}ms instead of {expected["median_ms"]:.1f}ms')
+    return regressions
@@ -0,0 +1,111 @@
+"""
+Versioned cache of article API responses
+
+Every cached response is stored under the current generation of articles.
+Any write to articles bumps the generation - so the old entries are never read again
+and expire on their own, writes never have to look for keys to delete
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+GENERATION_KEY = 'news:articles:generation'
+KEY_PREFIX = 'news:articles:response'
+
+# how long the first request may compute a response while identical requests wait for it (seconds)
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # start from current time, so a generation lost by eviction can't repeat one already used
+        cache.add(GENERATION_KEY, time.time_ns() // 1000, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidates all cached responses once the current transaction is committed -
+    a response computed before that would be cached with the old data under the new generation
+    """
+    transaction.on_commit(increment_generation)
+
+
+def increment_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        get_generation()
+
+
+def get_cache_key(request):
+    """
+    Key of the response - normalized URL of the request under the current generation
+    Order of query parameters does not matter
+    """
+    query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    url = f'{request.scheme}://{request.get_host()}{request.path}?{query}'
+    return f'{KEY_PREFIX}:{get_generation()}:{hashlib.sha1(url.encode()).hexdigest()}'
+
+
+def get_or_compute(key, compute, timeout):
+    """
+    Returns data cached under the key or computes it
+    Only one caller computes data for a cold key, the others wait until it's in cache (stampede protection)
+
+    :param compute: function returning (data, cacheable)
+    :return: data
+    """
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    lock = f'{key}:lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not cache.add(lock, 1, LOCK_TIMEOUT):
+        time.sleep(LOCK_POLL_INTERVAL)
+        data = cache.get(key)
+        if data is not None:
+            return data
+        if time.monotonic() > deadline:
+            # the one holding the lock takes too long - do not wait any more
+            return compute()[0]
+
+    try:
+        data, cacheable = compute()
+        if cacheable:
+            cache.set(key, data, timeout)
+        return data
+    finally:
+        cache.delete(lock)
+
+
+def cache_response(func):
+    """
+    Decorator of viewset method that caches successful responses for NEWS_CACHE_TIMEOUT seconds
+    """
+
+    @functools.wraps(func)
+    def wrap(view, request, *args, **kwargs):
+        if not settings.NEWS_CACHE_TIMEOUT:
+            return func(view, request, *args, **kwargs)
+
+        response = None
+
+        def compute():
+            nonlocal response
+            response = func(view, request, *args, **kwargs)
+            return response.data, response.status_code == 200
+
+        data = get_or_compute(get_cache_key(request), compute, settings.NEWS_CACHE_TIMEOUT)
+        return response if response is not None else Response(data)
+
+    return wrap
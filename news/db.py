@@ -0,0 +1,144 @@
+"""
+Routing of queries to read replicas and health of persistent connections
+
+Replicas are configured by DB_REPLICA_HOSTS (see settings). Reads of safe requests (GET, HEAD, OPTIONS)
+go to a replica, everything else - to the primary (default database):
+writes and reads of unsafe requests, reads in transactions and after a write of the request,
+reads of a client for DB_REPLICA_PIN_SECONDS after its write (replicas may lag behind) - per a cookie,
+and all queries out of requests (commands, background jobs).
+A thread keeps reading from the same replica - to reuse its connection, an unreachable replica is skipped
+for DB_REPLICA_RETRY_SECONDS and reads go to the primary if none is left.
+Connections are kept between requests for CONN_MAX_AGE seconds, RoutingMiddleware closes the broken ones
+before a request uses them
+"""
+import contextvars
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, models, router
+
+PIN_COOKIE = 'news_db_pin'
+
+_routing = contextvars.ContextVar('news_db_routing', default=None)
+# replica of the thread and time (monotonic) until which unreachable replicas are skipped
+_local = threading.local()
+_down = {}
+
+
+class Routing:
+    """
+    Routing state of one request
+    """
+
+    def __init__(self, pinned=False):
+        # reads go to the primary
+        self.pinned = pinned
+        self.wrote = False
+        self.replica = None
+        self.selected = False
+
+
+def close_if_broken(alias):
+    """
+    Closes a persistent connection which is not usable any more (e.g. the server restarted)
+    Connections in a transaction are left to fail it
+    """
+    connection = connections[alias]
+    if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+        connection.close()
+
+
+def check_connection(alias):
+    """
+    :return bool: False if the database is not reachable
+    """
+    try:
+        close_if_broken(alias)
+        connections[alias].ensure_connection()
+        return True
+    except DatabaseError:
+        return False
+
+
+def select_replica():
+    """
+    :return str: alias of a reachable replica - the one of the thread while it's reachable, None if there is none
+    """
+    now = time.monotonic()
+    aliases = [x for x in settings.DATABASE_REPLICAS if _down.get(x, 0) <= now]
+    random.shuffle(aliases)
+    current = getattr(_local, 'replica', None)
+    if current in aliases:
+        aliases.remove(current)
+        aliases.insert(0, current)
+    for alias in aliases:
+        if check_connection(alias):
+            _local.replica = alias
+            return alias
+        _down[alias] = now + settings.DB_REPLICA_RETRY_SECONDS
+    return None
+
+
+class ReplicaRouter:
+    """
+    Database router of DATABASE_ROUTERS, installed when replicas are configured
+    """
+
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if routing is None or routing.pinned or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # the replica is selected on the first read - requests without queries don't connect to it
+        if not routing.selected:
+            routing.replica = select_replica()
+            routing.selected = True
+        return routing.replica or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.pinned = routing.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas have the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class RoutingMiddleware:
+    """
+    Sets routing state of requests, closes broken persistent connections before them
+    and pins reads of the client to the primary after its write
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for alias in connections:
+            close_if_broken(alias)
+
+        routing = Routing(pinned=request.method not in ('GET', 'HEAD', 'OPTIONS') or PIN_COOKIE in request.COOKIES)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if routing.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.DB_REPLICA_PIN_SECONDS, httponly=True)
+        return response
+
+
+class PrimaryManager(models.Manager):
+    """
+    Manager of writes with raw SQL - its database is the one of writes, not of reads
+    """
+
+    @property
+    def db(self):
+        return self._db or router.db_for_write(self.model, **self._hints)
@@ -0,0 +1,28 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    Replacement of SearchFilter with the same `search` query parameter
+    Terms are matched against the stored tsvector (GIN index) instead of ILIKE over the text columns
+
+    All terms must match. Results are ranked by relevance unless explicit ordering is requested
+    """
+    search_vector_field = 'search_vector'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        query = SearchQuery(' '.join(terms), config=queryset.model.SEARCH_CONFIG, search_type='plain')
+        queryset = queryset.filter(**{self.search_vector_field: query})
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            return queryset
+
+        return queryset.annotate(
+            search_rank=SearchRank(F(self.search_vector_field), query)
+        ).order_by('-search_rank', *queryset.query.order_by)
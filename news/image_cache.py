@@ -0,0 +1,129 @@
+"""
+Local copies of external images of articles
+
+Each external image is downloaded once per URL by a bounded pool of threads of the process,
+resized to derivatives (see news.images) and then served instead of the external URL.
+Ingestion only schedules the downloads - slow image hosts never hold it up
+"""
+import hashlib
+import io
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from news import images, models
+from news.cache import bump_generation
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+# downloads waiting in the executor - over NEWS_IMAGE_CACHE_QUEUE new ones are dropped
+_queue = None
+
+
+def get_executor():
+    global _executor, _queue
+    with _executor_lock:
+        if _executor is None:
+            _queue = threading.BoundedSemaphore(settings.NEWS_IMAGE_CACHE_QUEUE)
+            _executor = ThreadPoolExecutor(max_workers=settings.NEWS_IMAGE_CACHE_WORKERS,
+                                           thread_name_prefix='image-cache')
+    return _executor
+
+
+def get_url_hash(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def download(url):
+    """
+    :return bytes: content of the image, not longer than NEWS_IMAGE_CACHE_MAX_SIZE
+    """
+    with requests.get(url, timeout=settings.NEWS_IMAGE_CACHE_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        content = io.BytesIO()
+        for chunk in response.iter_content(64 * 1024):
+            content.write(chunk)
+            if content.tell() > settings.NEWS_IMAGE_CACHE_MAX_SIZE:
+                raise ValueError(f'Image is larger than {settings.NEWS_IMAGE_CACHE_MAX_SIZE} bytes')
+    return content.getvalue()
+
+
+def cache_image(url, article_ids):
+    """
+    Makes the local copy of the image unless the URL was already tried
+    and links it to the articles
+
+    :return str: content hash of the copy, None if the image can't be downloaded
+    """
+    cached, _ = models.CachedImage.objects.get_or_create(url_hash=get_url_hash(url), defaults={'url': url})
+    if cached.status == models.CachedImage.FAILED:
+        return None
+    if cached.status == models.CachedImage.PENDING:
+        try:
+            content = download(url)
+            cached.content_hash = hashlib.sha256(content).hexdigest()
+            images.create_derivatives(io.BytesIO(content), cached.content_hash)
+            cached.status = models.CachedImage.DONE
+        except Exception as e:
+            logger.warning(f'Failed to cache image {url}: {e}')
+            cached.status, cached.error = models.CachedImage.FAILED, str(e)
+        cached.fetched = timezone.now()
+        cached.save(update_fields=['content_hash', 'status', 'error', 'fetched'])
+        if cached.status == models.CachedImage.FAILED:
+            return None
+
+    if models.Article.objects.filter(pk__in=article_ids).update(external_image_hash=cached.content_hash):
+        bump_generation()
+    return cached.content_hash
+
+
+def group_by_image(articles):
+    """
+    :return dict: external image URL - ids of the articles without local copy of it
+    """
+    urls = defaultdict(list)
+    for article in articles:
+        if article.external_image and not article.external_image_hash:
+            urls[article.external_image].append(article.pk)
+    return urls
+
+
+def submit(articles):
+    """
+    Schedules copying of external images of the articles once the current transaction is committed
+    With NEWS_IMAGE_CACHE_EAGER images are copied right away in the calling thread
+    """
+    if not settings.NEWS_IMAGE_CACHE:
+        return
+    for url, article_ids in group_by_image(articles).items():
+        if settings.NEWS_IMAGE_CACHE_EAGER:
+            cache_image(url, article_ids)
+        else:
+            transaction.on_commit(lambda url=url, article_ids=article_ids: enqueue(url, article_ids))
+
+
+def enqueue(url, article_ids):
+    executor = get_executor()
+    if not _queue.acquire(blocking=False):
+        logger.info(f'Image cache queue is full, {url} is skipped')
+        return
+    executor.submit(cache_image_in_thread, url, article_ids)
+
+
+def cache_image_in_thread(url, article_ids):
+    close_old_connections()
+    try:
+        cache_image(url, article_ids)
+    except Exception:
+        logger.exception(f'Failed to cache image {url}')
+    finally:
+        _queue.release()
+        connection.close()
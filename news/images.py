@@ -0,0 +1,80 @@
+"""
+Derivatives of images - downscaled copies in a compact format for responsive clients
+
+Derivatives are stored under MEDIA_ROOT and keyed by hash of the original content and width,
+so creating them again for the same image is a no-op and equal images share their derivatives
+"""
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+DIRECTORY = 'derivatives'
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+
+
+def get_content_hash(file):
+    sha = hashlib.sha256()
+    for chunk in file.chunks():
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_name(content_hash, width):
+    extension = EXTENSIONS.get(settings.NEWS_IMAGE_FORMAT, settings.NEWS_IMAGE_FORMAT.lower())
+    return f'{DIRECTORY}/{content_hash[:2]}/{content_hash}/{width}.{extension}'
+
+
+def resize(file, width):
+    """
+    :return bytes: the image not wider than width in NEWS_IMAGE_FORMAT, smaller images are not upscaled
+    """
+    file.seek(0)
+    with Image.open(file) as original:
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((width, image.height * width // image.width or 1))
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        if settings.NEWS_IMAGE_FORMAT == 'JPEG' or not has_alpha:
+            image = image.convert('RGB')
+        else:
+            image = image.convert('RGBA')
+        buffer = io.BytesIO()
+        image.save(buffer, settings.NEWS_IMAGE_FORMAT, quality=settings.NEWS_IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def create_derivative(file, content_hash, width, storage=default_storage):
+    name = get_name(content_hash, width)
+    if not storage.exists(name):
+        storage.save(name, ContentFile(resize(file, width)))
+    return name
+
+
+def create_derivatives(file, content_hash, storage=default_storage):
+    """
+    Creates missing derivatives of all NEWS_IMAGE_WIDTHS
+    """
+    return {width: create_derivative(file, content_hash, width, storage) for width in settings.NEWS_IMAGE_WIDTHS}
+
+
+def get_url(content_hash, storage=default_storage):
+    """
+    :return str: URL of the largest derivative
+    """
+    return storage.url(get_name(content_hash, max(settings.NEWS_IMAGE_WIDTHS)))
+
+
+def get_srcset(content_hash, storage=default_storage):
+    """
+    :return dict: URL of derivative per width (as string) or None if there is no image.
+    Without NEWS_IMAGE_EAGER the URLs lead to the view that creates derivatives on the first request
+    """
+    if not content_hash:
+        return None
+    if settings.NEWS_IMAGE_EAGER:
+        return {str(width): storage.url(get_name(content_hash, width)) for width in settings.NEWS_IMAGE_WIDTHS}
+    return {str(width): reverse('articles-image', args=[content_hash, width]) for width in settings.NEWS_IMAGE_WIDTHS}
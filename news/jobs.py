@@ -0,0 +1,68 @@
+"""
+In-process runner of ingestion jobs
+Jobs are stored in DB (see IngestJob) and executed by a pool of threads of the web process - no external broker
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from news import models
+from news.management.commands.get_articles_from_newsapi import fetch_articles, save_articles
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.NEWS_INGEST_WORKERS, thread_name_prefix='ingest')
+    return _executor
+
+
+def submit(job):
+    """
+    Schedules the job to run once the transaction that created it is committed
+    With NEWS_INGEST_JOBS_EAGER the job runs right away in the calling thread
+    """
+    if settings.NEWS_INGEST_JOBS_EAGER:
+        run(job.pk)
+    else:
+        transaction.on_commit(lambda: get_executor().submit(run_in_thread, job.pk))
+
+
+def run_in_thread(job_id):
+    close_old_connections()
+    try:
+        run(job_id)
+    finally:
+        connection.close()
+
+
+def run(job_id):
+    jobs = models.IngestJob.objects.filter(pk=job_id)
+    started = jobs.filter(status=models.IngestJob.QUEUED).update(status=models.IngestJob.RUNNING,
+                                                                 updated=timezone.now())
+    if not started:
+        return  # taken by another worker or timed out
+
+    try:
+        query, period = jobs.values_list('query', 'period').get()
+        from_time = models.IngestWatermark.objects.get_from_times([query], period).get(query)
+        covered_from = models.IngestWatermark.objects.get_window_start(period, from_time)
+        articles, complete = fetch_articles(query, period, from_time)
+        jobs.update(found=len(articles), updated=timezone.now())
+
+        new_articles = save_articles(query, articles, complete, covered_from)
+        jobs.update(status=models.IngestJob.DONE, new_article_ids=[x.pk for x in new_articles],
+                    updated=timezone.now(), finished=timezone.now())
+    except Exception as e:
+        logger.exception(f'Ingestion job {job_id} failed')
+        jobs.update(status=models.IngestJob.FAILED, error=str(e), updated=timezone.now(), finished=timezone.now())
@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+import time
+
+import django.core.management.base as base
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from news import models, partitions
+from news.cache import bump_generation
+from news.utils import NewsApi
+
+CHUNK_SIZE = 2000
+
+EXPORT_SQL = """
+SELECT a.id, a.title, a.description, a.timestamp, a.external_url, a.external_image, a.image, a.canonical_id,
+    au.username, au.first_name, au.last_name
+FROM {partition} a
+JOIN news_author au ON au.id = a.author_id
+ORDER BY a.timestamp, a.id
+"""
+
+# rows referring to the articles of the partition - there are no foreign keys to cascade
+CLEANUP_SQL = """
+DELETE FROM news_article_keywords WHERE article_id IN (SELECT id FROM {partition});
+DELETE FROM news_relatedarticle
+WHERE article_id IN (SELECT id FROM {partition}) OR related_id IN (SELECT id FROM {partition});
+UPDATE news_article SET canonical_id = NULL WHERE canonical_id IN (SELECT id FROM {partition});
+DELETE FROM news_keywordtrend WHERE bucket >= %(start)s AND bucket < %(end)s;
+DROP TABLE {partition};
+"""
+
+
+def to_news_api(row):
+    """
+    :return dict: article in the format of newsapi.org - as import_articles loads it, with its id and local image
+    """
+    pk, title, description, timestamp, url, image_url, image, canonical_id, username, first_name, last_name = row
+    author = ' '.join(filter(None, (first_name, last_name))) or username
+    return {
+        'id': pk,
+        'author': None if username == models.Author.UNKNOWN else author,
+        'title': title,
+        'content': description,
+        'url': url,
+        'urlToImage': image_url,
+        'publishedAt': timestamp.astimezone(timezone.utc).strftime(NewsApi.DATETIME_FORMAT),
+        'image': image,
+        'canonical_id': canonical_id,
+    }
+
+
+class Command(base.BaseCommand):
+    help = "Moves articles of the months older than the retention to compressed NDJSON files " \
+           "(per month, in the format of newsapi.org - import_articles loads them back). " \
+           "Partitions of the months are detached and dropped"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--months', type=int, default=settings.NEWS_RETENTION_MONTHS,
+                            help="Retention: number of months before the current one kept in the database")
+        parser.add_argument('--path', default=settings.NEWS_ARCHIVE_PATH, help="Directory of the archives")
+
+    @staticmethod
+    def archive(month, partition, path):
+        """
+        Detaches the partition, writes its articles to the archive and drops it - all in one transaction
+        :return int: number of articles archived
+        """
+        start, end = partitions.get_bounds(month)
+        name = os.path.join(path, f'{partition}.ndjson.gz')
+        count = 0
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE {partitions.TABLE} DETACH PARTITION {partition}')
+            with connection.chunked_cursor() as cursor, gzip.open(f'{name}.tmp', 'wt', encoding='utf-8') as file:
+                cursor.execute(EXPORT_SQL.format(partition=partition))
+                for rows in iter(lambda: cursor.fetchmany(CHUNK_SIZE), []):
+                    file.writelines(json.dumps(to_news_api(row)) + '\n' for row in rows)
+                    count += len(rows)
+            with connection.cursor() as cursor:
+                cursor.execute(CLEANUP_SQL.format(partition=partition), {'start': start, 'end': end})
+        os.replace(f'{name}.tmp', name)
+        return count
+
+    def handle(self, *args, **options):
+        retention = options['months']
+        if retention < 1:
+            raise base.CommandError('Retention is not set: pass --months or set NEWS_RETENTION_MONTHS')
+        path = options.get('path') or settings.NEWS_ARCHIVE_PATH
+        os.makedirs(path, exist_ok=True)
+
+        start = time.perf_counter()
+        cutoff = partitions.add_months(partitions.get_month(timezone.now()), -retention)
+        with transaction.atomic(), connection.cursor() as cursor:
+            # old articles of the default partition are archived with their months
+            for month in partitions.get_default_months(cursor):
+                if month < cutoff:
+                    partitions.create_partition(cursor, month)
+            old = [(month, name) for month, name in partitions.get_partitions(cursor).items() if month < cutoff]
+
+        total = 0
+        for month, partition in old:
+            count = self.archive(month, partition, path)
+            total += count
+            self.stdout.write(f'{partition}: {count} articles archived')
+        if old:
+            bump_generation()
+
+        self.stdout.write(
+            f'Archived {total} articles of {len(old)} months before {cutoff:%Y-%m} to {path} '
+            f'in {time.perf_counter() - start:.2f}s'
+        )
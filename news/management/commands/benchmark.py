@@ -0,0 +1,60 @@
+import json
+import os
+
+import django.core.management.base as base
+from django.db import connection
+
+from news import benchmark
+
+
+class Command(base.BaseCommand):
+    help = "Measures latency and number of queries of the article API and of ingestion on a synthetic corpus. " \
+           "The first run records the baseline, next ones fail if they are slower than the baseline"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--size', type=int, default=10000, help="Number of articles in the corpus")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the corpus")
+        parser.add_argument('--repeat', type=int, default=5, help="Measured runs of every scenario")
+        parser.add_argument('--ingest-size', type=int, default=500,
+                            help="Number of articles downloaded from newsapi.org stub per run")
+        parser.add_argument('--baseline', default='benchmark.json', help="JSON file with the baseline")
+        parser.add_argument('--threshold', type=float, default=benchmark.THRESHOLD,
+                            help="Relative slowdown of median latency treated as regression")
+        parser.add_argument('--update-baseline', action='store_true', help="Overwrite the baseline with this run")
+        parser.add_argument('--in-place', action='store_true',
+                            help="Load the corpus into the configured database "
+                                 "instead of a temporary test database")
+
+    def handle(self, *args, **options):
+        params = {x: options[x] for x in ('size', 'seed', 'repeat', 'ingest_size')}
+        if options.get('in_place'):
+            results = benchmark.run(**params)
+        else:  # pragma: no cover
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                results = benchmark.run(**params)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(f'Corpus of {params["size"]} articles loaded at '
+                          f'{results["meta"]["load_rows_per_second"]} rows/s')
+        self.stdout.write(f'{"scenario":<20}{"queries":>8}{"median, ms":>12}{"p95, ms":>10}')
+        for name, result in results['scenarios'].items():
+            self.stdout.write(f'{name:<20}{result["queries"]:>8}{result["median_ms"]:>12.1f}{result["p95_ms"]:>10.1f}')
+
+        path = options['baseline']
+        if options.get('update_baseline') or not os.path.exists(path):
+            with open(path, 'w') as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write(f'Baseline is saved to {path}')
+            return
+
+        with open(path) as file:
+            baseline = json.load(file)
+        if any(baseline['meta'].get(x) != value for x, value in params.items()):
+            raise base.CommandError(f'Baseline {path} is recorded with other parameters: {baseline["meta"]}')
+
+        regressions = benchmark.compare(results, baseline, options['threshold'])
+        if regressions:
+            raise base.CommandError('Regressions against {}:\n{}'.format(path, '\n'.join(regressions)))
+        self.stdout.write(f'No regressions against {path}')
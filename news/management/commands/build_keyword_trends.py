@@ -0,0 +1,27 @@
+import datetime
+import time
+
+import django.core.management.base as base
+from django.utils import timezone
+
+from news import models
+from news.cache import bump_generation
+
+
+class Command(base.BaseCommand):
+    help = "Recomputes trending keywords (articles per keyword and hour) from the keyword index, " \
+           "e.g. to backfill them after import of articles or to repair drift. They are updated on ingestion"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--days', type=int,
+                            help="Recompute only the articles published in this number of days, all by default")
+
+    def handle(self, *args, **options):
+        days = options.get('days')
+        since = timezone.now() - datetime.timedelta(days=days) if days else None
+        start = time.perf_counter()
+        rows = models.KeywordTrend.objects.rebuild(since)
+        bump_generation()
+
+        period = f'the last {days} days' if since else 'all articles'
+        self.stdout.write(f'Trending keywords of {period}: {rows} rows in {time.perf_counter() - start:.2f}s')
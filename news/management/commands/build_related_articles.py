@@ -0,0 +1,43 @@
+import logging
+import time
+
+import django.core.management.base as base
+from django.db import connection
+
+from news import models
+from news.cache import bump_generation
+
+DEFAULT_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class Command(base.BaseCommand):
+    help = "Recomputes related articles of all articles, e.g. after import of articles. " \
+           "New articles are added to them on ingestion"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of articles computed per query")
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size') or DEFAULT_BATCH_SIZE
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            # weights of keywords depend on the number of articles in statistics of the table
+            cursor.execute('ANALYZE news_article, news_article_keywords')
+
+        ids = models.Article.objects.order_by('id').values_list('id', flat=True)
+        total = links = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            links += models.RelatedArticle.objects.rebuild(batch)
+            total += len(batch)
+            last_id = batch[-1]
+            logger.info(f'{total} articles, {links} related, {total / (time.perf_counter() - start):.0f} articles/s')
+        bump_generation()
+
+        self.stdout.write(f'Related articles of {total} articles: {links} in {time.perf_counter() - start:.2f}s')
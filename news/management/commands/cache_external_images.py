@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django.core.management.base as base
+from django.conf import settings
+from django.db import connection
+
+from news import image_cache, models
+from news.management.commands.import_articles import batched
+
+BATCH_SIZE = 1000
+
+
+def cache_image_in_thread(item):  # pragma: no cover
+    try:
+        return image_cache.cache_image(*item)
+    finally:
+        connection.close()
+
+
+class Command(base.BaseCommand):
+    help = "Makes local copies of external images of the articles that don't have them yet " \
+           "- e.g. of imported articles or of the ones skipped on ingestion"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--workers', type=int, default=settings.NEWS_IMAGE_CACHE_WORKERS,
+                            help="Number of images downloaded at the same time")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Download again the images that failed before")
+
+    def handle(self, *args, **options):
+        workers = options.get('workers') or settings.NEWS_IMAGE_CACHE_WORKERS
+        if options.get('retry_failed'):
+            models.CachedImage.objects.filter(status=models.CachedImage.FAILED).update(
+                status=models.CachedImage.PENDING, error=''
+            )
+
+        articles = models.Article.objects.filter(external_image_hash='').exclude(external_image=None).exclude(
+            external_image=''
+        ).only('id', 'external_image', 'external_image_hash').order_by('id')
+
+        cached = failed = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in batched(articles.iterator(chunk_size=BATCH_SIZE), BATCH_SIZE):
+                items = image_cache.group_by_image(batch).items()
+                if workers > 1:  # pragma: no cover
+                    results = executor.map(cache_image_in_thread, items)
+                else:
+                    results = (image_cache.cache_image(*item) for item in items)
+                for content_hash in results:
+                    if content_hash:
+                        cached += 1
+                    else:
+                        failed += 1
+
+        self.stdout.write(f'Images cached: {cached}, failed: {failed} in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,25 @@
+import django.core.management.base as base
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from news import partitions
+
+
+class Command(base.BaseCommand):
+    help = "Creates monthly partitions of articles for the months ahead and for the months of the articles " \
+           "in the default partition (they are moved to them). Meant to be scheduled, e.g. daily"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--months', type=int, default=settings.NEWS_PARTITION_MONTHS_AHEAD,
+                            help="Number of months ahead of the current one")
+
+    def handle(self, *args, **options):
+        ahead = options['months']
+        current = partitions.get_month(timezone.now())
+        with transaction.atomic(), connection.cursor() as cursor:
+            months = {partitions.add_months(current, x) for x in range(ahead + 1)}
+            months |= set(partitions.get_default_months(cursor))
+            created = [partitions.get_name(x) for x in sorted(months) if partitions.create_partition(cursor, x)]
+
+        self.stdout.write(f'Partitions created: {", ".join(created) or "none"}')
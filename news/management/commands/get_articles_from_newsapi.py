@@ -1,35 +1,111 @@
 import django.core.management.base as base
 from django.conf import settings
-import datetime
-from news import models
-from news.utils import NewsApi
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from news import image_cache, models
+from news.metrics import timed
+from news.utils import NewsApi, RateLimiter
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONCURRENCY = 4
 
-def download_articles(query, period):
-    news_api = NewsApi(settings.NEWS_PORTAL_KEY)
-    articles = news_api.get_articles(query=query, period=period)
-    logger.info(f'Found {len(articles)} articles')
-
-    new_articles = []
-    for article in articles:
-        article_obj, created = models.Article.objects.get_or_create_from_news_api(**article)
-        if created:
-            new_articles.append(article_obj)
+# shared by all threads of the process - quota of newsapi.org is per API key
+rate_limiter = RateLimiter(settings.NEWS_API_RATE_LIMIT, settings.NEWS_API_RATE_BURST)
+
+
+def get_news_api():
+    return NewsApi(
+        settings.NEWS_PORTAL_KEY,
+        url=settings.NEWS_API_URL,
+        timeout=settings.NEWS_API_TIMEOUT,
+        retries=settings.NEWS_API_RETRIES,
+        rate_limiter=rate_limiter,
+        max_pages=settings.NEWS_API_MAX_PAGES,
+    )
+
+
+def fetch_articles(query, period, from_time=None):
+    """
+    Gets all pages of articles from newsapi.org - does not touch DB, so it's safe to run in threads
+    :param from_time: watermark of the query, see IngestWatermark
+    :return tuple: articles, True if all of them were received
+    """
+    with timed('fetch'):
+        articles, complete = get_news_api().get_all_articles(query=query, period=period, from_time=from_time)
+    logger.info(f'Found {len(articles)} articles for "{query}"')
+    return articles, complete
+
+
+def save_articles(query, articles, complete=True, covered_from=None):
+    """
+    :param covered_from: start of the window the articles were requested for, see IngestWatermark.advance()
+    """
+    with timed('persist'):
+        new_articles = models.Article.objects.bulk_create_from_news_api(articles)
+        # with partial results older articles are still missing - next run has to start from the same point
+        if complete:
+            models.IngestWatermark.objects.advance(query, articles, covered_from)
+    image_cache.submit(new_articles)
     logger.info(f"Added {len(new_articles)} new articles")
     return new_articles
 
 
+def download_articles(query, period):
+    from_time = models.IngestWatermark.objects.get_from_times([query], period).get(query)
+    covered_from = models.IngestWatermark.objects.get_window_start(period, from_time)
+    return save_articles(query, *fetch_articles(query, period, from_time), covered_from)
+
+
 class Command(base.BaseCommand):
     def add_arguments(self, parser):  # pragma: no cover
         parser.add_argument('--query', required=True,
-                            help="query to search news")
+                            help="query to search news, comma-separated for several topics")
         parser.add_argument('--period', type=int, required=True,
                             help="Period of news in days in the past from today")
+        parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                            help="Number of topics fetched from newsapi.org at the same time")
 
     def handle(self, *args, **options):
-        queries = options.get('query').split(',')
-        for q in queries:
-            download_articles(q.strip(), options.get('period'))
+        """
+        Topics are fetched in a thread pool, while articles are saved in the main thread
+        as soon as each topic arrives - so DB writes never run concurrently
+        """
+        queries = [q.strip() for q in options.get('query').split(',')]
+        period = options.get('period')
+        concurrency = options.get('concurrency') or DEFAULT_CONCURRENCY
+        from_times = models.IngestWatermark.objects.get_from_times(queries, period)
+
+        covered_from = {q: models.IngestWatermark.objects.get_window_start(period, from_times.get(q)) for q in queries}
+
+        def timed_fetch(query):
+            start = time.perf_counter()
+            return fetch_articles(query, period, from_times.get(query)), time.perf_counter() - start
+
+        fetch_time = persist_time = 0
+        found = added = 0
+        failed = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(timed_fetch, q): q for q in queries}
+            for future in as_completed(futures):
+                try:
+                    (articles, complete), elapsed = future.result()
+                except Exception as e:
+                    logger.error(f'Failed to get articles for "{futures[future]}": {e}')
+                    failed.append(futures[future])
+                    continue
+
+                fetch_time += elapsed
+                persist_start = time.perf_counter()
+                found += len(articles)
+                added += len(save_articles(futures[future], articles, complete, covered_from[futures[future]]))
+                persist_time += time.perf_counter() - persist_start
+
+        self.stdout.write(
+            f'Topics: {len(queries)}, found: {found}, added: {added} articles in {time.perf_counter() - start:.2f}s '
+            f'(fetching: {fetch_time:.2f}s over all topics, persisting: {persist_time:.2f}s)'
+        )
+        if failed:
+            raise base.CommandError(f'Failed to get articles for: {", ".join(failed)}')
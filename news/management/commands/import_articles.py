@@ -0,0 +1,241 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import time
+
+import django.core.management.base as base
+from django.db import connection, transaction
+
+from news import models
+from news.cache import bump_generation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+NULL = r'\N'
+
+STAGING_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS news_import_article (
+    url text, title text, description text, timestamp timestamptz, external_image text,
+    username text, first_name text, last_name text, signature bigint[], canonical_id bigint, canonical_url text
+);
+CREATE TEMP TABLE IF NOT EXISTS news_import_keyword (url text, name text);
+CREATE TEMP TABLE IF NOT EXISTS news_import_new (id bigint, url text);
+TRUNCATE news_import_article, news_import_keyword, news_import_new;
+"""
+
+MERGE_AUTHORS_SQL = """
+INSERT INTO news_author (username, first_name, last_name, email)
+SELECT DISTINCT s.username, s.first_name, s.last_name, ''
+FROM news_import_article s
+WHERE NOT EXISTS (
+    SELECT 1 FROM news_author a
+    WHERE a.username = s.username AND a.first_name = s.first_name AND a.last_name = s.last_name
+)
+"""
+
+MERGE_ARTICLES_SQL = """
+WITH inserted AS (
+    INSERT INTO news_article (
+        title, description, author_id, timestamp, image, image_hash, external_image, external_image_hash, external_url,
+        signature, canonical_id
+    )
+    SELECT s.title, s.description, a.id, s.timestamp, '', '', s.external_image, '', s.url, s.signature, s.canonical_id
+    FROM news_import_article s
+    JOIN (
+        SELECT DISTINCT ON (username, first_name, last_name) id, username, first_name, last_name
+        FROM news_author
+        WHERE (username, first_name, last_name) IN (SELECT username, first_name, last_name FROM news_import_article)
+        ORDER BY username, first_name, last_name, id
+    ) a USING (username, first_name, last_name)
+    WHERE NOT EXISTS (SELECT 1 FROM news_article x WHERE x.external_url = s.url)
+    RETURNING id, external_url
+)
+INSERT INTO news_import_new SELECT id, external_url FROM inserted
+"""
+
+# near-duplicates of articles of the same batch
+LINK_DUPLICATES_SQL = """
+UPDATE news_article a SET canonical_id = c.id
+FROM news_import_new n
+JOIN news_import_article s ON s.url = n.url
+JOIN news_article c ON c.external_url = s.canonical_url
+WHERE a.id = n.id AND s.canonical_url IS NOT NULL
+"""
+
+MERGE_KEYWORDS_SQL = """
+INSERT INTO news_keyword (name)
+SELECT DISTINCT s.name FROM news_import_keyword s JOIN news_import_new n ON n.url = s.url
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO news_article_keywords (article_id, keyword_id)
+SELECT n.id, k.id
+FROM news_import_new n
+JOIN news_import_keyword s ON s.url = n.url
+JOIN news_keyword k ON k.name = s.name
+ON CONFLICT DO NOTHING;
+"""
+
+
+def open_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def iter_ndjson(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_json_array(file, chunk_size=1 << 16):
+    """
+    Stream parser of a JSON array of objects - either the document itself
+    or "articles" of a newsapi.org response. Only one chunk of the file is kept in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def read():
+        nonlocal buffer, eof
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+    # skip to the beginning of the array
+    read()
+    while not eof and '[' not in buffer.lstrip()[:1] and '"articles"' not in buffer:
+        read()
+    start = buffer.find('"articles"') if not buffer.lstrip().startswith('[') else 0
+    if start < 0:
+        raise ValueError('JSON is neither an array nor a response of newsapi.org')
+    while '[' not in buffer[start:]:
+        if eof:
+            raise ValueError('Unexpected end of JSON')
+        read()
+    buffer = buffer[buffer.index('[', start) + 1:]
+
+    while True:
+        buffer = buffer.lstrip(' \t\r\n,')
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read()
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def iter_articles(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    with open_file(path) as file:
+        if name.endswith(NDJSON_EXTENSIONS):
+            yield from iter_ndjson(file)
+        else:
+            yield from iter_json_array(file)
+
+
+def copy_rows(cursor, table, rows):
+    """
+    Loads rows to the table with COPY
+    None is written as \\N - so COPY tells NULL from empty string
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([NULL if x is None else x for x in row] for row in rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv, NULL '{NULL}')", buffer)
+
+
+def import_batch(articles):
+    """
+    Stages a batch of newsapi.org articles with COPY and merges it into articles, authors and keywords
+    Articles which URL is already known (or repeated in the batch) are skipped
+
+    :return int: number of new articles
+    """
+    staged = {}
+    for article in articles:
+        url = article.get('url')
+        if url not in staged:
+            staged[url] = models.Article.objects._parse_news_api(**article)
+
+    articles = {url: models.Article(**fields) for url, (_, fields) in staged.items()}
+    canonical_urls = {
+        duplicate.external_url: canonical.external_url
+        for duplicate, canonical in models.Article.objects.link_duplicates(list(articles.values()))
+    }
+
+    article_rows = []
+    keyword_rows = []
+    for url, (author, fields) in staged.items():
+        article = articles[url]
+        article_rows.append((
+            url, fields['title'], fields['description'], fields['timestamp'].isoformat(), fields['external_image'],
+            author['username'], author['first_name'], author['last_name'],
+            '{%s}' % ','.join(map(str, article.signature)) if article.signature else None,
+            article.canonical_id, canonical_urls.get(url),
+        ))
+        keyword_rows += [(url, name) for name in models.Keyword.extract(fields['title'], fields['description'])]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        models.Article.objects.lock_ingestion()
+        cursor.execute(STAGING_SQL)
+        copy_rows(cursor, 'news_import_article', article_rows)
+        copy_rows(cursor, 'news_import_keyword', keyword_rows)
+        cursor.execute(MERGE_AUTHORS_SQL)
+        cursor.execute(MERGE_ARTICLES_SQL)
+        added = cursor.rowcount
+        cursor.execute(LINK_DUPLICATES_SQL)
+        cursor.execute(MERGE_KEYWORDS_SQL)
+        cursor.execute('SELECT id FROM news_import_new')
+        models.KeywordTrend.objects.add([pk for pk, in cursor.fetchall()])
+    return added
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(base.BaseCommand):
+    help = "Bulk import of articles from files in the format of newsapi.org: " \
+           "JSON (array or response of /v2/everything) or NDJSON (.ndjson, .jsonl), optionally gzipped"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('files', nargs='+', help="files to import")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of articles loaded per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size') or DEFAULT_BATCH_SIZE
+        total = added = 0
+        start = time.perf_counter()
+        try:
+            for path in options['files']:
+                for batch in batched(iter_articles(path), batch_size):
+                    added += import_batch(batch)
+                    total += len(batch)
+                    elapsed = time.perf_counter() - start
+                    logger.info(f'{path}: {total} articles read, {added} added, {total / elapsed:.0f} rows/s')
+        finally:
+            if added:
+                bump_generation()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'Read {total} articles, added {added} in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f} rows/s)'
+        )
@@ -0,0 +1,125 @@
+import datetime
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django.core.management.base as base
+from django.db import transaction
+from django.db.models import Max, Min
+
+from news import analyzer, models
+from news.cache import bump_generation
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_CHECKPOINT = 'reindex_keywords.json'
+DATE_FORMAT = '%Y-%m-%d'
+
+logger = logging.getLogger(__name__)
+
+
+class Command(base.BaseCommand):
+    help = "Rebuilds the keyword index of all articles (or of the ones published within dates), " \
+           "e.g. after a change of news.analyzer. Text is analyzed by a pool of processes, " \
+           "an interrupted run is resumed from the checkpoint"
+
+    def add_arguments(self, parser):  # pragma: no cover
+        parser.add_argument('--from-date', help=f"Articles published since the date, {DATE_FORMAT}")
+        parser.add_argument('--to-date', help=f"Articles published until the date (inclusive), {DATE_FORMAT}")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Size of id ranges analyzed by a process and written per transaction")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of processes")
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help="JSON file with the last re-indexed id, it's deleted once all articles are done")
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help="Delete keywords of no articles at the end")
+
+    @staticmethod
+    def parse_date(value):
+        try:
+            return datetime.datetime.strptime(value, DATE_FORMAT).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            raise base.CommandError(f'{value} has wrong date format. Expected: {DATE_FORMAT}')
+
+    @staticmethod
+    def read_checkpoint(path, params):
+        """
+        :return int: the last id re-indexed with the same parameters, 0 - to start from the beginning
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path) as file:
+            checkpoint = json.load(file)
+        if checkpoint['params'] != params:
+            raise base.CommandError(f'Checkpoint {path} is of other parameters: {checkpoint["params"]}')
+        return checkpoint['last_id']
+
+    @staticmethod
+    def write(words):
+        """
+        Replaces the keywords of a range of articles, together with their trends
+        :return int: number of links
+        """
+        ids = list(words)
+        with transaction.atomic():
+            models.KeywordTrend.objects.remove(ids)
+            links = models.Keyword.objects.link(words, replace=True)
+            models.KeywordTrend.objects.add(ids)
+        return links
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size') or DEFAULT_BATCH_SIZE
+        workers = options.get('workers') or 1
+        path = options.get('checkpoint') or DEFAULT_CHECKPOINT
+        params = {'from_date': options.get('from_date'), 'to_date': options.get('to_date'), 'batch_size': batch_size}
+
+        articles = models.Article.objects.all()
+        if params['from_date']:
+            articles = articles.filter(timestamp__gte=self.parse_date(params['from_date']))
+        if params['to_date']:
+            articles = articles.filter(timestamp__lt=self.parse_date(params['to_date']) + datetime.timedelta(days=1))
+
+        last_id = self.read_checkpoint(path, params)
+        bounds = articles.filter(id__gt=last_id).aggregate(first=Min('id'), last=Max('id'))
+        ranges = range(bounds['first'], bounds['last'] + 1, batch_size) if bounds['first'] else []
+
+        def read(start):
+            return list(articles.filter(id__gte=start, id__lt=start + batch_size).values_list(
+                'id', 'title', 'description'
+            ))
+
+        total = links = 0
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # ranges are read ahead while the processes analyze the previous ones, and written in order
+            pending = deque()
+            for start in [*ranges, None]:
+                if start is not None:
+                    rows = read(start)
+                    if workers > 1:
+                        pending.append((start, executor.submit(analyzer.analyze_rows, rows)))
+                    else:
+                        pending.append((start, analyzer.analyze_rows(rows)))
+                while pending and (start is None or len(pending) > workers):
+                    done, words = pending.popleft()
+                    if workers > 1:
+                        words = words.result()
+                    links += self.write(words)
+                    total += len(words)
+                    with open(path, 'w') as file:
+                        json.dump({'params': params, 'last_id': done + batch_size - 1}, file)
+                    elapsed = time.perf_counter() - start_time
+                    logger.info(f'{total} articles re-indexed, {links} links, {total / elapsed:.0f} articles/s')
+
+        if os.path.exists(path):
+            os.remove(path)
+        orphans = models.Keyword.objects.delete_orphans() if options.get('delete_orphans') else 0
+        bump_generation()
+
+        elapsed = time.perf_counter() - start_time
+        self.stdout.write(
+            f'Re-indexed {total} articles: {links} links, {orphans} orphaned keywords deleted in {elapsed:.2f}s '
+            f'({total / max(elapsed, 1e-9):.0f} articles/s)'
+        )
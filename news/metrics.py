@@ -0,0 +1,188 @@
+"""
+Timing of requests and of their stages
+
+Every request is measured by TimingMiddleware: total time, number and time of DB queries and time of stages
+marked with timed() - e.g. serialization or rendering. Measurements are returned in Server-Timing header
+and collected into histograms exposed in Prometheus text format by metrics view.
+Histograms are kept in memory of the process - with several worker processes each of them is scraped separately
+"""
+import bisect
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+slow_request_logger = logging.getLogger('news.slow_requests')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    """
+    Thread-safe histogram with a series per combination of label values
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[x]) for x in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # observations per bucket (the last one is +Inf) and their sum
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 1) + [0])
+            series[index] += 1
+            series[-1] += value
+
+    @staticmethod
+    def format_labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def collect(self):
+        """
+        :return list: lines of Prometheus text format
+        """
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, values in series:
+            pairs = list(zip(self.labels, key))
+            count = 0
+            for bound, observations in zip(self.buckets + ('+Inf',), values):
+                count += observations
+                lines.append(f'{self.name}_bucket{self.format_labels(pairs + [("le", bound)])} {count}')
+            lines.append(f'{self.name}_sum{self.format_labels(pairs)} {values[-1]}')
+            lines.append(f'{self.name}_count{self.format_labels(pairs)} {count}')
+        return lines
+
+
+REQUEST_DURATION = Histogram('news_request_duration_seconds', 'Duration of requests',
+                             labels=('view', 'method', 'status'))
+REQUEST_QUERIES = Histogram('news_request_db_queries', 'Number of DB queries per request',
+                            labels=('view',), buckets=QUERY_BUCKETS)
+REQUEST_DB_DURATION = Histogram('news_request_db_duration_seconds', 'Duration of DB queries per request',
+                                labels=('view',))
+STAGE_DURATION = Histogram('news_stage_duration_seconds', 'Duration of stages of requests and of ingestion',
+                           labels=('stage',))
+HISTOGRAMS = [REQUEST_DURATION, REQUEST_QUERIES, REQUEST_DB_DURATION, STAGE_DURATION]
+
+
+class Timings:
+    """
+    Measurements of one request, also the execute wrapper counting its DB queries
+    """
+
+    def __init__(self, capture_sql=False):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.db_time = 0
+        self.sql = [] if capture_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_time += elapsed
+            if self.sql is not None:
+                self.sql.append((elapsed, sql))
+
+    def get_server_timing(self, total):
+        metrics = [f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"']
+        metrics += [f'{stage};dur={elapsed * 1000:.1f}' for stage, elapsed in self.stages.items()]
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+_timings = contextvars.ContextVar('news_timings', default=None)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Measures a stage of the current request (if any) and observes it in STAGE_DURATION
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.stages[stage] = timings.stages.get(stage, 0) + elapsed
+
+
+class TimingMiddleware:
+    """
+    Measures requests, adds Server-Timing header to responses
+    and logs SQL of requests slower than NEWS_SLOW_REQUEST_MS
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = Timings(capture_sql=bool(settings.NEWS_SLOW_REQUEST_MS))
+        token = _timings.set(timings)
+        try:
+            with contextlib.ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        total = time.perf_counter() - timings.start
+
+        view = getattr(request.resolver_match, 'url_name', None) or 'unknown'
+        REQUEST_DURATION.observe(total, view=view, method=request.method, status=response.status_code)
+        REQUEST_QUERIES.observe(timings.queries, view=view)
+        REQUEST_DB_DURATION.observe(timings.db_time, view=view)
+        response['Server-Timing'] = timings.get_server_timing(total)
+
+        if settings.NEWS_SLOW_REQUEST_MS and total * 1000 > settings.NEWS_SLOW_REQUEST_MS:
+            queries = '\n'.join(f'{elapsed * 1000:.1f}ms {sql}' for elapsed, sql in timings.sql)
+            slow_request_logger.warning(
+                f'{request.method} {request.get_full_path()} took {total * 1000:.0f}ms, '
+                f'{timings.queries} queries:\n{queries}'
+            )
+        return response
+
+    def process_template_response(self, request, response):
+        """
+        Responses of DRF are rendered after the view - wraps rendering to measure it
+        """
+        render = response.render
+
+        def timed_render():
+            with timed('render'):
+                return render()
+
+        response.render = timed_render
+        return response
+
+
+def metrics(request):
+    """
+    Histograms of the process in Prometheus text format
+    """
+    lines = [line for histogram in HISTOGRAMS for line in histogram.collect()]
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,70 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+import django.contrib.postgres.search
+from django.db import migrations
+
+BACKFILL_BATCH_SIZE = 5000
+
+SEARCH_VECTOR_SQL = """
+    setweight(to_tsvector('pg_catalog.english', coalesce({table}title, '')), 'A') ||
+    setweight(to_tsvector('pg_catalog.english', coalesce({table}description, '')), 'B')
+"""
+
+CREATE_TRIGGER_SQL = f"""
+CREATE FUNCTION news_article_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {SEARCH_VECTOR_SQL.format(table='NEW.')};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER news_article_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON news_article
+    FOR EACH ROW EXECUTE PROCEDURE news_article_search_vector_update();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS news_article_search_vector_trigger ON news_article;
+DROP FUNCTION IF EXISTS news_article_search_vector_update();
+"""
+
+
+def backfill_search_vector(apps, schema_editor):
+    """
+    Fills search vector of existing articles in id ranges
+    The migration is not atomic so every batch is committed separately
+    and rows are not locked for the whole backfill
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT min(id), max(id) FROM news_article')
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return
+        for start in range(min_id, max_id + 1, BACKFILL_BATCH_SIZE):
+            cursor.execute(
+                f'UPDATE news_article SET search_vector = {SEARCH_VECTOR_SQL.format(table="")} '
+                f'WHERE id >= %s AND id < %s AND search_vector IS NULL',
+                [start, start + BACKFILL_BATCH_SIZE]
+            )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('news', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, DROP_TRIGGER_SQL),
+        migrations.RunPython(backfill_search_vector, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='article',
+            index=GinIndex(fields=['search_vector'], name='news_article_search_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('news', '0002_article_search_vector'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='article',
+            index=models.Index(fields=['-timestamp', '-id'], name='news_article_timestamp_id_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0003_article_timestamp_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=255, unique=True)),
+                ('published_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.contrib.postgres.indexes import HashIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('news', '0005_ingestjob'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='article',
+            index=HashIndex(fields=['external_url'], name='news_article_url_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+from news import images
+
+
+def set_image_hashes(apps, schema_editor):
+    Article = apps.get_model('news', 'Article')
+    for article in Article.objects.exclude(image='').only('id', 'image').iterator():
+        try:
+            with article.image.open('rb') as file:
+                image_hash = images.get_content_hash(file)
+        except FileNotFoundError:
+            continue
+        Article.objects.filter(pk=article.pk).update(image_hash=image_hash)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('news', '0006_article_url_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='image_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(set_image_hashes, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='article',
+            index=models.Index(condition=models.Q(('image_hash', ''), _negated=True), fields=['image_hash'],
+                               name='news_article_image_hash_idx'),
+        ),
+    ]
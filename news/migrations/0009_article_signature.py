@@ -0,0 +1,53 @@
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+from news import duplicates
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_signature(apps, schema_editor):
+    """
+    Fills signatures of existing articles in id ranges, every batch is committed separately
+    Existing articles are not linked to canonical ones
+    """
+    Article = apps.get_model('news', 'Article')
+    articles = Article.objects.filter(signature=None).order_by('id')
+    last_id = 0
+    while True:
+        batch = list(articles.filter(id__gt=last_id).only('id', 'title', 'description')[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            return
+        for article in batch:
+            article.signature = duplicates.get_signature(duplicates.get_words(article.title, article.description))
+        Article.objects.bulk_update([x for x in batch if x.signature is not None], ['signature'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('news', '0008_cachedimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='canonical',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='news.article'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='signature',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), editable=False, null=True, size=6),
+        ),
+        migrations.RunPython(backfill_signature, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='article',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('canonical', None)), fields=['signature'], name='news_article_signature_idx'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0010_relatedarticle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestwatermark',
+            name='covered_from',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0011_ingestwatermark_covered_from'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeywordTrend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(help_text='Start of the hour')),
+                ('count', models.IntegerField()),
+                ('keyword', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='news.keyword')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='keywordtrend',
+            index=models.Index(fields=['bucket'], name='news_keywordtrend_bucket_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='keywordtrend',
+            constraint=models.UniqueConstraint(fields=('keyword', 'bucket'), name='news_keywordtrend_unique'),
+        ),
+        # the articles already there
+        migrations.RunSQL(
+            """
+            INSERT INTO news_keywordtrend (keyword_id, bucket, count)
+            SELECT link.keyword_id, date_trunc('hour', article.timestamp), count(*)
+            FROM news_article_keywords link
+            JOIN news_article article ON article.id = link.article_id
+            GROUP BY 1, 2
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+from news.analyzer import STOPWORDS
+
+# the empty keyword (of punctuation-only words) and stopwords are not indexed any more
+DELETE_SQL = """
+DELETE FROM news_keywordtrend WHERE keyword_id IN (SELECT id FROM news_keyword WHERE name = ANY(%(names)s));
+DELETE FROM news_article_keywords WHERE keyword_id IN (SELECT id FROM news_keyword WHERE name = ANY(%(names)s));
+DELETE FROM news_keyword WHERE name = ANY(%(names)s);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0012_keywordtrend'),
+    ]
+
+    operations = [
+        migrations.RunSQL([(DELETE_SQL, {'names': ['', *sorted(STOPWORDS)]})], migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,91 @@
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from news import partitions
+
+
+def partition_articles(apps, schema_editor):
+    """
+    Replaces news_article with the table partitioned by month of timestamp and copies the articles into it
+    Primary key of a partitioned table must include the partition key, so it's (id, timestamp) and nothing
+    can reference articles by a foreign key: constraints of keyword links, related articles and canonical
+    articles are dropped - Article deletes them on its own (on_delete of the fields is done by Django)
+    """
+    table = partitions.TABLE
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = %s::regclass', [table])
+        if cursor.fetchone()[0] == 'p':
+            return
+
+        cursor.execute(f"SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> '{table}_pkey'",
+                       [table])
+        indexes = [x for x, in cursor.fetchall()]
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                       "WHERE conrelid = %s::regclass AND contype = 'f' AND confrelid <> conrelid", [table])
+        foreign_keys = cursor.fetchall()
+        cursor.execute('SELECT pg_get_triggerdef(oid) FROM pg_trigger '
+                       'WHERE tgrelid = %s::regclass AND NOT tgisinternal', [table])
+        triggers = [x for x, in cursor.fetchall()]
+        cursor.execute("SELECT conrelid::regclass::text, conname FROM pg_constraint "
+                       "WHERE confrelid = %s::regclass AND contype = 'f' AND confrelid <> conrelid", [table])
+        for referencing, name in cursor.fetchall():
+            cursor.execute(f'ALTER TABLE {referencing} DROP CONSTRAINT {name}')
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+        sequence, = cursor.fetchone()
+
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_unpartitioned')
+        cursor.execute(f'ALTER TABLE {table}_unpartitioned '
+                       f'RENAME CONSTRAINT {table}_pkey TO {table}_unpartitioned_pkey')
+        cursor.execute(f'CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS INCLUDING STORAGE) '
+                       f'PARTITION BY RANGE ("timestamp")')
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, "timestamp")')
+        cursor.execute(f'CREATE TABLE {partitions.DEFAULT_PARTITION} PARTITION OF {table} DEFAULT')
+
+        # partitions of the months with articles and of the months ahead, the rest is in the default partition
+        cursor.execute(f"SELECT DISTINCT date_trunc('month', timestamp) FROM {table}_unpartitioned")
+        current = partitions.get_month(datetime.datetime.now(datetime.timezone.utc))
+        months = {partitions.get_month(x) for x, in cursor.fetchall()}
+        months |= {partitions.add_months(current, x) for x in range(settings.NEWS_PARTITION_MONTHS_AHEAD + 1)}
+        for month in sorted(months):
+            partitions.create_partition(cursor, month)
+
+        # indexes and triggers are created after the rows are copied - the copy does not maintain them
+        cursor.execute(f'INSERT INTO {table} SELECT * FROM {table}_unpartitioned')
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+        cursor.execute(f'DROP TABLE {table}_unpartitioned')
+        for sql in indexes + triggers:
+            cursor.execute(sql)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0013_delete_stopword_keywords'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_articles),
+        # the foreign keys of keyword links of the articles are dropped too, but they are not in the state
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='article',
+                name='canonical',
+                field=models.ForeignKey(blank=True, db_constraint=False, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='news.article'),
+            ),
+            migrations.AlterField(
+                model_name='relatedarticle',
+                name='article',
+                field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='related_links', to='news.article'),
+            ),
+            migrations.AlterField(
+                model_name='relatedarticle',
+                name='related',
+                field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='related_to', to='news.article'),
+            ),
+        ]),
+    ]
@@ -1,12 +1,45 @@
 import datetime
+from collections import defaultdict
 
-import pytz
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, connections, models, router, transaction
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, HashIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.functions import Greatest
+from news import analyzer, duplicates, images
+from news.db import PrimaryManager
 from news.utils import NewsApi
+from news.cache import bump_generation
 from django.utils import timezone
 
 
+class AuthorManager(models.Manager):
+    def get_or_create_many(self, names):
+        """
+        Bulk version of get_or_create() for a set of authors
+        Takes one query to find existing authors and one to insert the missing ones
+
+        :param names: iterable of dicts with username, first_name and last_name
+        :return dict: (username, first_name, last_name) -> Author
+        """
+        keys = {(x['username'], x['first_name'], x['last_name']) for x in names}
+        authors = {}
+        for author in self.get_queryset().filter(username__in={x[0] for x in keys}):
+            key = (author.username, author.first_name, author.last_name)
+            if key in keys:
+                authors.setdefault(key, author)
+
+        missing = [
+            self.model(username=username, first_name=first_name, last_name=last_name)
+            for username, first_name, last_name in keys - authors.keys()
+        ]
+        for author in self.bulk_create(missing):
+            authors[(author.username, author.first_name, author.last_name)] = author
+        return authors
+
+
 class Author(models.Model):
     UNKNOWN = 'Unknown Author'
 
@@ -18,52 +51,49 @@ class Author(models.Model):
     email = models.EmailField(blank=True)
     username = models.CharField(max_length=150)
 
-    objects = models.Manager()
+    objects = AuthorManager()
+
+    @classmethod
+    def parse_name(cls, author=None):
+        """
+        Splits author's name as it comes from newsapi.org into model fields
+        :return dict: username, first_name and last_name
+        """
+        if author is None:
+            first_name, last_name = cls.UNKNOWN.split()
+            return dict(username=cls.UNKNOWN, first_name=first_name, last_name=last_name)
+
+        tokens = author.split()
+        username = first_name = tokens[0]
+        if len(tokens) > 1:
+            last_name = tokens[1]
+        else:
+            last_name = ''
+        return dict(username=username, first_name=first_name, last_name=last_name)
 
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
 
 
-class ArticleManager(models.Manager):
-    def get_or_create_from_news_api(self, author=None, title='', description='',
-                                    urlToImage='', publishedAt=None, content='', url=None, **kwargs):
-        """
-        Takes one article from newsapi.org and saves it to DB
-        All parameters per response of newsapi.org
+class ArticleQuerySet(models.QuerySet):
+    def delete(self):
+        self._for_write = True
+        # articles are taken out of the trends while their keyword links are still there
+        with transaction.atomic(using=self.db):
+            KeywordTrend.objects.db_manager(self.db).remove(list(self.values_list('id', flat=True)))
+            return super().delete()
 
-        Repeats the behaviour of standard objects.get_or_create()
 
-        :return tuple:  object created or fetched, True/False if object was created
+class ArticleManager(PrimaryManager.from_queryset(ArticleQuerySet)):
+    @staticmethod
+    def _parse_news_api(author=None, title='', description='',
+                        urlToImage='', publishedAt=None, content='', url=None, **kwargs):
         """
-        # if url is None:
-        #     return None, False
-
-        try:
-            return self.get_queryset().get(external_url=url), False
-        except ObjectDoesNotExist:
-            pass
-
-        if author is None:
-            first_name, last_name = Author.UNKNOWN.split()
-            obj_author, _ = Author.objects.get_or_create(
-                username=Author.UNKNOWN, first_name=first_name, last_name=last_name
-            )
-        else:
-            tokens = author.split()
-            username = first_name = tokens[0]
-            if len(tokens) > 1:
-                last_name = tokens[1]
-            else:
-                last_name = ''
-            obj_author, _ = Author.objects.get_or_create(
-                username=username, first_name=first_name, last_name=last_name
-            )
+        Converts one article from newsapi.org into Article fields
 
-        try:
-            timestamp = datetime.datetime.strptime(publishedAt, NewsApi.DATETIME_FORMAT)
-            timestamp = pytz.utc.localize(timestamp)
-        except ValueError:
-            timestamp = timezone.now()
+        :return tuple: author's name fields, article fields
+        """
+        timestamp = NewsApi.parse_datetime(publishedAt) or timezone.now()
 
         # remove truncation e.g. [+1234 chars] from content
         try:
@@ -72,24 +102,211 @@ class ArticleManager(models.Manager):
         except ValueError:
             pass
 
-        article = self.create(
+        return Author.parse_name(author), dict(
             title=title,
             description=content,
-            author=obj_author,
             timestamp=timestamp,
             external_url=url,
             external_image=urlToImage,
         )
 
+    def get_or_create_from_news_api(self, url=None, **kwargs):
+        """
+        Takes one article from newsapi.org and saves it to DB
+        All parameters per response of newsapi.org
+
+        Repeats the behaviour of standard objects.get_or_create()
+
+        :return tuple:  object created or fetched, True/False if object was created
+        """
+        try:
+            return self.get_queryset().get(external_url=url), False
+        except ObjectDoesNotExist:
+            pass
+
+        author, fields = self._parse_news_api(url=url, **kwargs)
+        obj_author, _ = Author.objects.get_or_create(**author)
+        article = self.create(author=obj_author, **fields)
+
         return article, True
 
+    def bulk_create_from_news_api(self, articles):
+        """
+        Takes a batch of articles from newsapi.org and saves the new ones to DB
+        Works as get_or_create_from_news_api() called for every article,
+        but the number of queries does not depend on the size of the batch
+
+        :param articles: list of articles per response of newsapi.org
+        :return list: articles that were created, in the order of the batch
+        """
+        parsed = {}
+        for article in articles:
+            # the first occurrence of the URL wins - as with sequential get_or_create
+            parsed.setdefault(article.get('url'), self._parse_news_api(**article))
+
+        # articles are saved together with their keywords - or not at all, otherwise they would never be indexed
+        with transaction.atomic(using=self.db):
+            self.lock_ingestion()
+            existing = set(
+                self.get_queryset().filter(external_url__in=list(parsed)).values_list('external_url', flat=True)
+            )
+            parsed = {url: value for url, value in parsed.items() if url not in existing}
+            if not parsed:
+                return []
+
+            authors = Author.objects.get_or_create_many(author for author, _ in parsed.values())
+            new_articles = [
+                self.model(author=authors[(author['username'], author['first_name'], author['last_name'])], **fields)
+                for author, fields in parsed.values()
+            ]
+            # duplicates of articles of the same batch are inserted after them - to know id of their canonical
+            linked = self.link_duplicates(new_articles)
+            later = {id(duplicate) for duplicate, _ in linked}
+            self.bulk_create([x for x in new_articles if id(x) not in later])
+            if linked:
+                for duplicate, canonical in linked:
+                    duplicate.canonical_id = canonical.pk
+                self.bulk_create([duplicate for duplicate, _ in linked])
+
+            Keyword.objects.index(new_articles)
+            KeywordTrend.objects.add([x.pk for x in new_articles])
+            RelatedArticle.objects.refresh([x.pk for x in new_articles])
+            bump_generation()
+            return new_articles
+
+    def lock_ingestion(self):
+        """
+        Makes concurrent ingestion (jobs, commands) add articles one transaction at a time -
+        external_url is not unique, so batches with the same URLs would both insert them
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('news_article_ingestion'))")
+
+    def link_duplicates(self, articles):
+        """
+        Sets signatures of new articles and links their near-duplicates to canonical articles:
+        the ones with similarity of words over NEWS_DUPLICATE_SIMILARITY published within NEWS_DUPLICATE_WINDOW_DAYS.
+        Canonical articles already in DB are looked up by one query for all articles
+
+        :param articles: unsaved Article objects
+        :return list: pairs of duplicate and its canonical article from the list - to be linked once it's saved
+        """
+        signed = [(article, article.set_signature()) for article in articles]
+        signed = [(article, words) for article, words in signed if article.signature is not None]
+        if not signed:
+            return []
+
+        window = datetime.timedelta(days=settings.NEWS_DUPLICATE_WINDOW_DAYS)
+        timestamps = [article.timestamp for article, _ in signed]
+        candidates = self.get_queryset().filter(
+            canonical=None,
+            signature__overlap=list({band for article, _ in signed for band in article.signature}),
+            timestamp__range=(min(timestamps) - window, max(timestamps) + window),
+        ).values_list('id', 'title', 'description', 'timestamp', 'signature')
+
+        # canonical articles (id of the saved ones, new ones as is) per band of their signatures
+        bands = defaultdict(list)
+        for pk, title, description, timestamp, signature in candidates:
+            for band in signature:
+                bands[band].append((pk, duplicates.get_words(title, description), timestamp))
+
+        def find_canonical(article, words):
+            for band in article.signature:
+                for canonical, canonical_words, timestamp in bands[band]:
+                    if abs(timestamp - article.timestamp) <= window and \
+                            duplicates.get_similarity(words, canonical_words) >= settings.NEWS_DUPLICATE_SIMILARITY:
+                        return canonical
+            return None
+
+        linked = []
+        for article, words in signed:
+            canonical = find_canonical(article, words)
+            if canonical is None:
+                for band in article.signature:
+                    bands[band].append((article, words, article.timestamp))
+            elif isinstance(canonical, int):
+                article.canonical_id = canonical
+            else:
+                linked.append((article, canonical))
+        return linked
+
+
+class KeywordManager(PrimaryManager):
+    DELETE_ORPHANS_SQL = """
+        WITH orphans AS (
+            SELECT id FROM news_keyword keyword
+            WHERE NOT EXISTS (SELECT 1 FROM news_article_keywords link WHERE link.keyword_id = keyword.id)
+        ), trends AS (
+            DELETE FROM news_keywordtrend WHERE keyword_id IN (SELECT id FROM orphans)
+        )
+        DELETE FROM news_keyword WHERE id IN (SELECT id FROM orphans)
+    """
+
+    def index(self, articles, replace=False):
+        """
+        Links articles to the keywords of their title and description
+        Takes one insert for the new keywords, one select for their ids
+        and one insert for the links - regardless of the number of articles
+
+        :param articles: saved Article objects
+        :param replace: drop the existing links of the articles first (re-indexing)
+        """
+        words = {}
+        for article in articles:
+            words[article.pk] = Keyword.extract(article.title, article.description)
+            article._indexed = article._get_indexed_values()
+        self.link(words, replace)
+
+    def link(self, words, replace=False):
+        """
+        Links articles to their keywords extracted beforehand, see index()
+
+        :param words: dict article id -> set of keywords
+        :param replace: drop the existing links of the articles first
+        :return int: number of links
+        """
+        through = Article.keywords.through
+        if replace:
+            through.objects.using(self.db).filter(article_id__in=list(words)).delete()
+
+        names = set().union(*words.values())
+        if not names:
+            return 0
+
+        self.bulk_create([self.model(name=name) for name in names], ignore_conflicts=True)
+        ids = dict(self.get_queryset().filter(name__in=names).values_list('name', 'id'))
+
+        links = through.objects.using(self.db).bulk_create([
+            through(article_id=article_id, keyword_id=ids[name])
+            for article_id, names in words.items() for name in names
+        ], ignore_conflicts=True)
+        return len(links)
+
+    def delete_orphans(self):
+        """
+        Deletes keywords of no articles (e.g. left by re-indexing) with their trends
+        Ingestion is locked meanwhile - it could link the keywords being deleted
+        :return int: number of keywords deleted
+        """
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            Article.objects.db_manager(self.db).lock_ingestion()
+            cursor.execute(self.DELETE_ORPHANS_SQL)
+            return cursor.rowcount
+
 
 class Keyword(models.Model):
     """
     Helper table for faster lookup of articles by keywords
     """
     name = models.CharField(max_length=255, unique=True)
-    objects = models.Manager()
+    objects = KeywordManager()
+
+    @staticmethod
+    def extract(*fields):
+        """
+        Splits text fields into set of keywords, see news.analyzer
+        """
+        return analyzer.analyze(*fields)
 
 
 class Article(models.Model):
@@ -98,21 +315,483 @@ class Article(models.Model):
     author = models.ForeignKey(Author, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(default=timezone.now)
     image = models.ImageField(upload_to='news_images', blank=True)
+    # sha256 of the image content - key of its derivatives, see news.images
+    image_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
     external_image = models.URLField(blank=True, default=None, null=True, max_length=2048)
+    # content hash of the local copy of external_image, see news.image_cache
+    external_image_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
     external_url = models.URLField(help_text="URL of the article if it's from external source", max_length=2048,
                                    blank=True)
+    # links have no foreign key to the partitioned table of articles (see news.partitions)
     keywords = models.ManyToManyField(Keyword, blank=True)
+    # maintained by DB trigger on insert and on update of title/description (see migration 0002)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # bands of MinHash signature of the words (see news.duplicates), None for too short texts
+    signature = ArrayField(models.BigIntegerField(), size=duplicates.BANDS, null=True, editable=False)
+    # the earliest article of the same story, None for the canonical articles themselves
+    canonical = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, editable=False,
+                                  related_name='duplicates', db_constraint=False)
 
     objects = ArticleManager()
 
+    # text search configuration the search vector is built with
+    SEARCH_CONFIG = 'english'
+
+    # fields the keywords are extracted from
+    INDEXED_FIELDS = ('title', 'description')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._indexed = instance._get_indexed_values()
+        instance._trended = instance.__dict__.get('timestamp')
+        return instance
+
+    def _get_indexed_values(self):
+        """
+        Values of indexed fields loaded into the object (deferred fields are None)
+        """
+        return tuple(self.__dict__.get(name) for name in self.INDEXED_FIELDS)
+
+    def set_signature(self):
+        """
+        :return set: words the signature is built from
+        """
+        words = duplicates.get_words(self.title, self.description)
+        self.signature = duplicates.get_signature(words)
+        return words
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        previous = getattr(self, '_indexed', None)
+        reindex = self._get_indexed_values() != previous
+        # the article is counted in the trends under the hour of its timestamp - once with the old one
+        moved = self.__dict__.get('timestamp') != getattr(self, '_trended', None)
+        retrend = not self._state.adding and (reindex or moved)
+        if retrend:
+            KeywordTrend.objects.db_manager(using).remove([self.pk])
+        if reindex:
+            if self._state.adding and self.canonical_id is None:
+                type(self).objects.db_manager(using).link_duplicates([self])
+            else:
+                self.set_signature()
+        # a new file is assigned to the image and not stored yet
+        new_image = bool(self.image) and not self.image._committed
+        if new_image:
+            self.image_hash = images.get_content_hash(self.image)
+        elif not self.image:
+            self.image_hash = ''
         super().save(force_insert, force_update, using, update_fields)
 
-        for fld in [self.title, self.description]:
-            words = {"".join([y for y in x.lower() if y.isalnum()]) for x in str(fld).split() if 3 < len(x) < 255}
-            for name in words:
-                keyword, _ = Keyword.objects.get_or_create(name=name)
-                self.keywords.add(keyword)
+        if new_image and settings.NEWS_IMAGE_EAGER:
+            self.create_image_derivatives()
+
+        # keywords are rebuilt only when the text has changed - e.g. not on image update
+        if reindex:
+            Keyword.objects.db_manager(self._state.db).index([self], replace=previous is not None)
+            RelatedArticle.objects.db_manager(self._state.db).refresh([self.pk], replace=previous is not None)
+        if reindex or retrend:
+            KeywordTrend.objects.db_manager(self._state.db).add([self.pk])
+            self._trended = self.__dict__.get('timestamp')
+        bump_generation()
+
+    def delete(self, using=None, keep_parents=False):
+        using = using or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            KeywordTrend.objects.db_manager(using).remove([self.pk])
+            return super().delete(using, keep_parents)
+
+    def create_image_derivatives(self):
+        with self.image.open('rb') as file:
+            return images.create_derivatives(file, self.image_hash)
 
     def __str__(self):
         return self.title
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='news_article_search_idx'),
+            # default ordering and keyset pagination
+            models.Index(fields=['-timestamp', '-id'], name='news_article_timestamp_id_idx'),
+            # lookups of known articles on ingestion - hash index is not limited by length of URL
+            HashIndex(fields=['external_url'], name='news_article_url_idx'),
+            # lookup of the original image by its derivative
+            models.Index(fields=['image_hash'], name='news_article_image_hash_idx', condition=~models.Q(image_hash='')),
+            # candidates for canonical article of a new one
+            GinIndex(fields=['signature'], name='news_article_signature_idx', condition=models.Q(canonical=None)),
+        ]
+
+
+class RelatedArticleManager(PrimaryManager):
+    # score of a pair of articles is the sum of IDF weights of their common keywords: ln(1 + N / df),
+    # where df is the number of articles with the keyword. Keywords of a single article can't relate
+    # and the ones of over NEWS_RELATED_MAX_KEYWORD_ARTICLES relate too much to matter (and to join cheaply).
+    # Related articles are canonical ones (see Article.canonical), not the article's own canonical
+    SCORES_SQL = """
+        WITH source AS (
+            SELECT article_id, keyword_id FROM news_article_keywords WHERE article_id = ANY(%(ids)s)
+        ), total AS (
+            -- statistics of the partitions of the table
+            SELECT GREATEST(sum(reltuples), 1) AS articles FROM pg_class
+            WHERE oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'news_article'::regclass)
+        ), weight AS (
+            SELECT keyword_id, ln(1 + (SELECT articles FROM total) / count(*)) AS weight
+            FROM news_article_keywords
+            WHERE keyword_id IN (SELECT keyword_id FROM source)
+            GROUP BY keyword_id
+            HAVING count(*) BETWEEN 2 AND %(max_keyword_articles)s
+        ), weighted AS MATERIALIZED (
+            -- keywords are filtered by weight before they are joined to their articles
+            SELECT source.article_id, source.keyword_id, weight.weight FROM source JOIN weight USING (keyword_id)
+        ), score AS (
+            SELECT weighted.article_id, link.article_id AS related_id, sum(weighted.weight) AS score
+            FROM weighted
+            JOIN news_article_keywords link
+                ON link.keyword_id = weighted.keyword_id AND link.article_id <> weighted.article_id
+            GROUP BY weighted.article_id, link.article_id
+        ), ranked AS (
+            SELECT score.*, article.canonical_id IS NULL AS is_canonical,
+                row_number() OVER (PARTITION BY score.article_id ORDER BY score.score DESC, score.related_id DESC)
+            FROM score
+            JOIN news_article article ON article.id = score.article_id
+            JOIN news_article related ON related.id = score.related_id AND related.canonical_id IS NULL
+            WHERE score.related_id IS DISTINCT FROM article.canonical_id
+        )
+    """
+    INSERT_SQL = SCORES_SQL + """
+        INSERT INTO news_relatedarticle (article_id, related_id, score)
+        SELECT article_id, related_id, score FROM ranked WHERE row_number <= %(count)s
+        -- a link may be added by a concurrent refresh between the delete and the insert
+        ON CONFLICT (article_id, related_id) DO UPDATE SET score = EXCLUDED.score
+    """
+    # also offers the articles as related to their neighbours - scores are symmetric
+    UPSERT_SQL = SCORES_SQL + """
+        INSERT INTO news_relatedarticle (article_id, related_id, score)
+        SELECT DISTINCT ON (article_id, related_id) article_id, related_id, score FROM (
+            SELECT article_id, related_id, score FROM ranked WHERE row_number <= %(count)s
+            UNION ALL
+            SELECT related_id, article_id, score FROM ranked WHERE row_number <= %(count)s AND is_canonical
+        ) pairs
+        ORDER BY article_id, related_id
+        ON CONFLICT (article_id, related_id) DO UPDATE SET score = EXCLUDED.score
+    """
+    # the lowest scored links beyond NEWS_RELATED_COUNT of the articles the new ones were offered to.
+    # ids are collected by an init plan walking the (article, -score) index per article,
+    # so the plan does not depend on statistics of the table
+    TRIM_SQL = """
+        DELETE FROM news_relatedarticle
+        WHERE id = ANY(ARRAY(
+            SELECT extra.id
+            FROM (SELECT DISTINCT article_id FROM news_relatedarticle WHERE related_id = ANY(%(ids)s)) affected
+            CROSS JOIN LATERAL (
+                SELECT id FROM news_relatedarticle r
+                WHERE r.article_id = affected.article_id
+                ORDER BY r.score DESC, r.related_id DESC
+                OFFSET %(count)s
+            ) extra
+        ))
+    """
+
+    def get_params(self, article_ids):
+        return {
+            'ids': list(article_ids),
+            'count': settings.NEWS_RELATED_COUNT,
+            'max_keyword_articles': settings.NEWS_RELATED_MAX_KEYWORD_ARTICLES,
+        }
+
+    def rebuild(self, article_ids):
+        """
+        Recomputes related articles of a batch of articles - one statement regardless of its size
+        :return int: number of links created
+        """
+        params = self.get_params(article_ids)
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute('DELETE FROM news_relatedarticle WHERE article_id = ANY(%(ids)s)', params)
+            cursor.execute(self.INSERT_SQL, params)
+            return cursor.rowcount
+
+    def refresh(self, article_ids, replace=False):
+        """
+        Incremental update for new (or re-indexed) articles: computes their related articles
+        and puts them among related articles of their neighbours, pushing out the lowest scored ones
+
+        :param replace: drop the existing links of the articles first (re-indexing)
+        """
+        if not article_ids:
+            return
+        params = self.get_params(article_ids)
+        # no transaction of its own - lists of the neighbours are only longer for a moment if it's interrupted
+        with connections[self.db].cursor() as cursor:
+            if replace:
+                cursor.execute('DELETE FROM news_relatedarticle WHERE article_id = ANY(%(ids)s) '
+                               'OR related_id = ANY(%(ids)s)', params)
+            cursor.execute(self.UPSERT_SQL, params)
+            cursor.execute(self.TRIM_SQL, params)
+
+
+class RelatedArticle(models.Model):
+    """
+    Precomputed "more like this": top NEWS_RELATED_COUNT articles with the most common keywords per article
+    Built by build_related_articles command and refreshed on ingestion.
+    Between rebuilds the lists are approximate - keyword weights drift as articles arrive
+    """
+    # lookups by article are covered by the indexes of Meta, articles are partitioned - no foreign keys to them
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='related_links', db_index=False,
+                                db_constraint=False)
+    related = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='related_to', db_constraint=False)
+    score = models.FloatField()
+
+    objects = RelatedArticleManager()
+
+    def __str__(self):
+        return f'{self.article_id} - {self.related_id}: {self.score:.2f}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['article', 'related'], name='news_relatedarticle_unique'),
+        ]
+        indexes = [
+            # related articles of an article in the order of the response
+            models.Index(fields=['article', '-score'], name='news_related_score_idx'),
+        ]
+
+
+class KeywordTrendManager(PrimaryManager):
+    # articles per keyword and hour of their timestamp, the articles are added with sign 1 and removed with -1
+    COUNT_SQL = """
+        INSERT INTO news_keywordtrend (keyword_id, bucket, count)
+        SELECT link.keyword_id, date_trunc('hour', article.timestamp), %(sign)s * count(*)
+        FROM news_article_keywords link
+        JOIN news_article article ON article.id = link.article_id
+        WHERE link.article_id = ANY(%(ids)s)
+        GROUP BY 1, 2
+        ON CONFLICT (keyword_id, bucket) DO UPDATE SET count = news_keywordtrend.count + EXCLUDED.count
+        RETURNING id, count
+    """
+    # counts of articles published since the time (all of them for None) computed from scratch
+    REBUILD_SQL = """
+        DELETE FROM news_keywordtrend WHERE %(since)s IS NULL OR bucket >= date_trunc('hour', %(since)s::timestamptz);
+        INSERT INTO news_keywordtrend (keyword_id, bucket, count)
+        SELECT link.keyword_id, date_trunc('hour', article.timestamp), count(*)
+        FROM news_article_keywords link
+        JOIN news_article article ON article.id = link.article_id
+        WHERE %(since)s IS NULL OR article.timestamp >= date_trunc('hour', %(since)s::timestamptz)
+        GROUP BY 1, 2;
+    """
+
+    def _count(self, article_ids, sign):
+        if not article_ids:
+            return
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(self.COUNT_SQL, {'ids': list(article_ids), 'sign': sign})
+            empty = [pk for pk, count in cursor.fetchall() if count <= 0]
+            if empty:
+                cursor.execute('DELETE FROM news_keywordtrend WHERE id = ANY(%s)', [empty])
+
+    def add(self, article_ids):
+        """
+        Counts indexed articles in the trends of their keywords - one statement for a batch
+        """
+        self._count(article_ids, 1)
+
+    def remove(self, article_ids):
+        """
+        Takes articles out of the trends before they are deleted or re-indexed
+        The rows counting no articles any more are deleted
+        """
+        self._count(article_ids, -1)
+
+    def rebuild(self, since=None):
+        """
+        Recomputes the trends from the keyword links, e.g. to backfill them or to repair drift
+        :param since: datetime to recompute the hours from, None - all of them
+        :return int: number of rows of the trends created
+        """
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            Article.objects.db_manager(self.db).lock_ingestion()
+            cursor.execute(self.REBUILD_SQL, {'since': since})
+            return cursor.rowcount
+
+    def trending(self, since):
+        """
+        :return QuerySet: (keyword name, number of articles) published since the time (rounded down to hour),
+        the most frequent first
+        """
+        return self.get_queryset().filter(bucket__gte=since.replace(minute=0, second=0, microsecond=0)).values_list(
+            'keyword__name'
+        ).annotate(articles=models.Sum('count')).order_by('-articles', 'keyword__name')
+
+
+class KeywordTrend(models.Model):
+    """
+    Number of articles per keyword and hour they are published in - aggregates of the keyword links
+    small enough to be summed up per request. Maintained on ingestion, save and delete of articles;
+    deletes bypassing Article (e.g. cascades of authors) are repaired by build_keyword_trends command
+    """
+    # lookups by keyword are covered by the unique constraint
+    keyword = models.ForeignKey(Keyword, on_delete=models.CASCADE, db_index=False)
+    bucket = models.DateTimeField(help_text="Start of the hour")
+    count = models.IntegerField()
+
+    objects = KeywordTrendManager()
+
+    def __str__(self):
+        return f'{self.keyword_id} at {self.bucket}: {self.count}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['keyword', 'bucket'], name='news_keywordtrend_unique'),
+        ]
+        indexes = [
+            # hours of the trending period
+            models.Index(fields=['bucket'], name='news_keywordtrend_bucket_idx'),
+        ]
+
+
+class IngestWatermarkManager(models.Manager):
+    def get_from_times(self, queries, period):
+        """
+        Exact start time to fetch each query from: publication time of the newest article already ingested
+        Queries without watermark or with the watermark older than period are not in the result
+
+        :return dict: query -> datetime
+        """
+        start = self.get_window_start(period)
+        # the watermark is of no use for a period longer than the one it was ingested for
+        return dict(self.get_queryset().filter(query__in=queries, published_at__gt=start, covered_from__lte=start)
+                    .values_list('query', 'published_at'))
+
+    @staticmethod
+    def get_window_start(period, from_time=None):
+        """
+        :return datetime: start of the window of articles requested by period, None if requested from watermark
+        """
+        if from_time is not None:
+            return None
+        return timezone.now() - datetime.timedelta(days=period)
+
+    def advance(self, query, articles, covered_from=None):
+        """
+        Moves watermark of the query to the newest of the articles (never backwards)
+        :param articles: articles per response of newsapi.org
+        :param covered_from: start of the window the articles were requested for by period,
+        None if they were requested from the watermark - it continues the window already covered
+        """
+        published = [NewsApi.parse_datetime(x.get('publishedAt')) for x in articles]
+        published = [x for x in published if x is not None]
+        if not published:
+            return
+        latest = max(published)
+
+        watermark, created = self.get_or_create(query=query, defaults={
+            'published_at': latest, 'covered_from': covered_from
+        })
+        if created:
+            return
+        if covered_from is not None and watermark.covered_from is not None and watermark.published_at >= covered_from:
+            # the windows overlap - together they cover from the earlier start
+            covered_from = min(covered_from, watermark.covered_from)
+        fields = {'covered_from': covered_from} if covered_from is not None else {}
+        self.get_queryset().filter(pk=watermark.pk).update(
+            published_at=Greatest('published_at', models.Value(latest, output_field=models.DateTimeField())), **fields
+        )
+
+
+class IngestWatermark(models.Model):
+    """
+    Publication time of the newest article ingested from newsapi.org per query
+    Next ingestion of the query requests only the articles published since then
+    unless it requests a longer period than the watermark covers
+    """
+    query = models.CharField(max_length=255, unique=True)
+    published_at = models.DateTimeField()
+    # start of the window all articles of the query are ingested from, None - unknown
+    covered_from = models.DateTimeField(null=True)
+
+    objects = IngestWatermarkManager()
+
+    def __str__(self):
+        return f'{self.query}: {self.published_at}'
+
+
+class IngestJobManager(models.Manager):
+    def enqueue(self, query, period):
+        """
+        Creates a job unless the same query and period is already queued or running
+        Stale jobs (not updated for NEWS_INGEST_JOB_TIMEOUT seconds - e.g. lost with a restarted worker)
+        are failed first, so they don't block new ones
+
+        :return tuple: job, True if the job was created
+        """
+        stale = timezone.now() - datetime.timedelta(seconds=settings.NEWS_INGEST_JOB_TIMEOUT)
+        self.get_queryset().filter(status__in=IngestJob.ACTIVE, updated__lt=stale).update(
+            status=IngestJob.FAILED, error='Job timed out', finished=timezone.now()
+        )
+
+        active = self.get_queryset().filter(query=query, period=period, status__in=IngestJob.ACTIVE)
+        while True:
+            job = active.first()
+            if job is not None:
+                return job, False
+            try:
+                with transaction.atomic():
+                    return self.create(query=query, period=period), True
+            except IntegrityError:
+                # the same job was created concurrently - it's active or already finished, so look again
+                continue
+
+
+class IngestJob(models.Model):
+    """
+    Download of articles from newsapi.org running in background
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(x, x) for x in (QUEUED, RUNNING, DONE, FAILED)]
+    ACTIVE = (QUEUED, RUNNING)
+
+    query = models.CharField(max_length=255)
+    period = models.IntegerField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    found = models.IntegerField(null=True, help_text="Number of articles received from newsapi.org")
+    new_article_ids = models.JSONField(default=list)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = IngestJobManager()
+
+    def __str__(self):
+        return f'{self.query} ({self.period} days): {self.status}'
+
+    class Meta:
+        constraints = [
+            # identical requests are merged into one job while it's in progress
+            models.UniqueConstraint(fields=['query', 'period'], condition=models.Q(status__in=('queued', 'running')),
+                                    name='news_ingestjob_unique_active'),
+        ]
+
+
+class CachedImage(models.Model):
+    """
+    Local copy of an external image - downloaded once per URL
+    Copies are stored as derivatives of their content (see news.images), so equal images share them
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(x, x) for x in (PENDING, DONE, FAILED)]
+
+    # sha256 of the URL - URLs are too long for a unique index
+    url_hash = models.CharField(max_length=64, unique=True)
+    url = models.URLField(max_length=2048)
+    content_hash = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    fetched = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'{self.url}: {self.status}'
@@ -0,0 +1,151 @@
+import base64
+import binascii
+import datetime
+
+from django.db import connections
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from news import partitions
+
+
+def estimate_count(queryset):
+    """
+    Number of rows of the queryset as estimated by PostgreSQL planner - approximate, but does not scan the table
+    Unfiltered queryset takes the table statistics from pg_class, filtered one - the estimate of EXPLAIN
+    """
+    with connections[queryset.db].cursor() as cursor:
+        if not queryset.query.where:
+            estimate = partitions.get_rows(cursor, queryset.model._meta.db_table)
+            if estimate is not None:
+                return estimate
+
+        # table was never analyzed or queryset is filtered
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        return int(cursor.fetchone()[0][0]['Plan']['Plan Rows'])
+
+
+class ArticlePagination(pagination.LimitOffsetPagination):
+    """
+    Limit/offset pagination with two additions for large tables
+
+    `cursor` parameter switches to keyset pagination over (timestamp, id):
+    pass it empty for the first page and follow `next` links after that.
+    Every page is a range scan of the (timestamp, id) index, so deep pages cost the same as the first one
+
+    `count` parameter defines how the total number of articles is obtained:
+    exact - COUNT(*) (default for limit/offset), estimate - planner estimate,
+    none - not counted at all (default for cursor pages)
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    count_modes = ('exact', 'estimate', 'none')
+    keyset_ordering = ('-timestamp', '-id')
+
+    has_next = False
+    next_position = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        if self.limit is None:  # pragma: no cover
+            return None
+        self.request = request
+
+        is_keyset = self.cursor_query_param in request.query_params
+        self.count_mode = self.get_count_mode(request, default='none' if is_keyset else 'exact')
+
+        if is_keyset:
+            return self.paginate_keyset(queryset, request)
+        if self.count_mode == 'exact':
+            return super().paginate_queryset(queryset, request, view)
+
+        self.offset = self.get_offset(request)
+        self.count = self.get_uncounted(queryset)
+        return self.get_page(queryset[self.offset:])
+
+    def get_count_mode(self, request, default):
+        mode = request.query_params.get(self.count_query_param) or default
+        if mode not in self.count_modes:
+            raise ValidationError(f"{self.count_query_param} must be one of: {', '.join(self.count_modes)}")
+        return mode
+
+    def get_uncounted(self, queryset):
+        """
+        Count for the modes which avoid COUNT(*)
+        """
+        if self.count_mode == 'estimate':
+            return estimate_count(queryset)
+        if self.count_mode == 'exact':
+            return self.get_count(queryset)
+        return None
+
+    def get_page(self, queryset):
+        """
+        Takes one extra row to know if there is a next page without counting
+        """
+        page = list(queryset[:self.limit + 1])
+        self.has_next = len(page) > self.limit
+        return page[:self.limit]
+
+    def paginate_keyset(self, queryset, request):
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            raise ValidationError(f'{self.cursor_query_param} pagination supports only the default ordering')
+
+        queryset = queryset.order_by(*self.keyset_ordering)
+        self.count = self.get_uncounted(queryset)
+
+        position = self.decode_cursor(request.query_params[self.cursor_query_param])
+        if position is not None:
+            timestamp, pk = position
+            # the first condition narrows the index range, the second one breaks ties of equal timestamps
+            queryset = queryset.filter(Q(timestamp__lte=timestamp), Q(timestamp__lt=timestamp) | Q(id__lt=pk))
+
+        page = self.get_page(queryset)
+        if self.has_next:
+            self.next_position = self.get_position(page[-1])
+        return page
+
+    @staticmethod
+    def get_position(row):
+        if isinstance(row, dict):
+            return row['timestamp'], row['id']
+        return row.timestamp, row.id
+
+    def encode_cursor(self, position):
+        timestamp, pk = position
+        return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{pk}'.encode()).decode()
+
+    def decode_cursor(self, value):
+        if not value:
+            return None
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(value.encode()).decode().split('|')
+            return datetime.datetime.fromisoformat(timestamp), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound('Invalid cursor')
+
+    def get_next_link(self):
+        if self.cursor_query_param in self.request.query_params:
+            if not self.has_next:
+                return None
+            url = remove_query_param(self.request.build_absolute_uri(), self.offset_query_param)
+            url = replace_query_param(url, self.limit_query_param, self.limit)
+            return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+        if self.count_mode == 'exact':
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_previous_link(self):
+        if self.cursor_query_param in self.request.query_params:
+            # keyset pages are read forward only
+            return None
+        return super().get_previous_link()
@@ -0,0 +1,99 @@
+"""
+Monthly range partitions of articles by timestamp (see migration 0014)
+
+Articles of a calendar month (UTC) are stored in partition news_article_pYYYYMM, articles of months without
+a partition - in the default one. Reads by date range and the newest pages scan only the partitions of their
+months, and vacuum and index maintenance of the old months is done once.
+Partitions are created ahead by create_article_partitions, the old ones are archived by archive_articles
+"""
+import datetime
+import re
+
+TABLE = 'news_article'
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION = re.compile(rf'^{TABLE}_p(\d{{4}})(\d{{2}})$')
+
+# the table and its partitions, the statistics of the partitioned table itself are not kept
+ROWS_SQL = """
+    SELECT coalesce(sum(GREATEST(reltuples, 0)), 0), coalesce(bool_or(reltuples >= 0), false) FROM pg_class
+    WHERE oid = %(table)s::regclass AND relkind <> 'p'
+        OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %(table)s::regclass)
+"""
+
+
+def get_month(value):
+    """
+    :return date: the first day of the month of the datetime (UTC)
+    """
+    return value.astimezone(datetime.timezone.utc).date().replace(day=1)
+
+
+def add_months(month, count):
+    month = month.year * 12 + month.month - 1 + count
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def get_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def get_bounds(month):
+    """
+    :return tuple: start of the month and of the next one, UTC
+    """
+    return tuple(
+        datetime.datetime(x.year, x.month, 1, tzinfo=datetime.timezone.utc) for x in (month, add_months(month, 1))
+    )
+
+
+def get_rows(cursor, table=TABLE):
+    """
+    Number of rows of the table (with its partitions) per table statistics
+    :return int: None if the table was never analyzed
+    """
+    cursor.execute(ROWS_SQL, {'table': table})
+    rows, analyzed = cursor.fetchone()
+    return int(rows) if analyzed else None
+
+
+def get_partitions(cursor):
+    """
+    :return dict: month -> name of its partition, the oldest first
+    """
+    cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', [TABLE])
+    partitions = {}
+    for name, in cursor.fetchall():
+        match = PARTITION.match(name)
+        if match:
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = name
+    return dict(sorted(partitions.items()))
+
+
+def get_default_months(cursor):
+    """
+    :return list: months of the articles in the default partition
+    """
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', timestamp) FROM {DEFAULT_PARTITION}")
+    return sorted(get_month(x) for x, in cursor.fetchall())
+
+
+def create_partition(cursor, month):
+    """
+    Creates the partition of the month, articles of the month are moved into it from the default partition
+    The partition gets the indexes, constraints and triggers of the table on attach
+
+    :return bool: False if the partition exists
+    """
+    name = get_name(month)
+    if month in get_partitions(cursor):
+        return False
+    start, end = get_bounds(month)
+    cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING STORAGE)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= %(start)s AND timestamp < %(end)s '
+        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+        {'start': start, 'end': end}
+    )
+    cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%(start)s) TO (%(end)s)',
+                   {'start': start, 'end': end})
+    return True
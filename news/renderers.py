@@ -0,0 +1,101 @@
+import csv
+
+import orjson
+from rest_framework import renderers
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """
+    JSONRenderer encoding with orjson - output is byte-for-byte the same
+    Types unknown to orjson (and datetimes, to keep their DRF format) are converted by DRF encoder
+    Indented output and non-default JSON settings are rendered by JSONRenderer itself
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or not self.strict or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        # the same escaping as JSONRenderer - to keep JSON a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """
+    Newline delimited JSON - one object per line
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b''.join(self.stream([data]))
+
+    @staticmethod
+    def stream(items):
+        for item in items:
+            yield orjson.dumps(item) + b'\n'
+
+
+class CSVRenderer(renderers.BaseRenderer):
+    """
+    CSV of flat objects (nested objects are flattened to `parent_child` columns)
+    The header is taken from the first object unless the columns are given
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        items = data if isinstance(data, list) else [data]
+        return ''.join(self.stream(x if isinstance(x, dict) else {'detail': x} for x in items))
+
+    @staticmethod
+    def flatten(item, prefix=''):
+        row = {}
+        for key, value in item.items():
+            if isinstance(value, dict):
+                row.update(CSVRenderer.flatten(value, f'{prefix}{key}_'))
+            else:
+                row[f'{prefix}{key}'] = value
+        return row
+
+    @classmethod
+    def stream(cls, items, fieldnames=None):
+        """
+        :param fieldnames: columns of the header - for objects of varying shape (e.g. a nested object or None),
+        columns missing in an object are empty and the ones not in the header are skipped
+        """
+        buffer = _LineBuffer()
+        writer = None
+        if fieldnames is not None:
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            yield buffer.pop()
+        for item in items:
+            row = cls.flatten(item)
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+                yield buffer.pop()
+            writer.writerow(row)
+            yield buffer.pop()
+
+
+class _LineBuffer:
+    """
+    File-like object csv writer writes into, lines are taken out as soon as they're written
+    """
+
+    def __init__(self):
+        self.value = ''
+
+    def write(self, value):
+        self.value += value
+
+    def pop(self):
+        value, self.value = self.value, ''
+        return value
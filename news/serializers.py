@@ -1,5 +1,8 @@
+import operator
+
+from django.conf import settings
 from rest_framework import serializers
-from news import models
+from news import images, models
 
 
 class AuthorSerializer(serializers.ModelSerializer):
@@ -11,16 +14,137 @@ class AuthorSerializer(serializers.ModelSerializer):
 class ArticleSerializer(serializers.ModelSerializer):
     author = AuthorSerializer()
     image_url = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
+
+    def __init__(self, *args, fields=None, **kwargs):
+        """
+        :param fields: names of the fields to serialize (sparse fieldset), None - all of them
+        """
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
     def get_image_url(self, obj):
         """
         If image attached locally - use it,
-        otherwise - use external image
+        otherwise - local copy of external image or external image itself
         """
         if obj.image:
             return obj.image.url
+        if obj.external_image_hash:
+            return images.get_url(obj.external_image_hash)
         return obj.external_image
 
+    def get_image_srcset(self, obj):
+        """
+        URLs of downscaled copies of the image per width
+        """
+        return images.get_srcset(obj.image_hash if obj.image else obj.external_image_hash)
+
     class Meta:
         model = models.Article
-        exclude = ('keywords', 'external_image', 'image',)
+        exclude = ('keywords', 'external_image', 'external_image_hash', 'image', 'image_hash', 'search_vector',
+                   'signature',)
+
+
+class ArticleRowSerializer:
+    """
+    Read-only equivalent of ArticleSerializer for the list endpoint
+    Works on values() rows joined to author instead of model instances and builds
+    exactly the same output without DRF field machinery
+    """
+    fields = ('id', 'author', 'image_url', 'image_srcset', 'title', 'description', 'timestamp', 'external_url',
+              'canonical')
+    # values of the rows each field is built from
+    field_values = {
+        'id': ('id',),
+        'author': ('author__first_name', 'author__last_name'),
+        'image_url': ('image', 'external_image', 'external_image_hash'),
+        'image_srcset': ('image', 'image_hash', 'external_image_hash'),
+        'title': ('title',),
+        'description': ('description',),
+        'timestamp': ('timestamp',),
+        'external_url': ('external_url',),
+        'canonical': ('canonical_id',),
+    }
+    # values of every row - position of the row for keyset pagination
+    required_values = ('id', 'timestamp')
+
+    def __init__(self, fields=None):
+        """
+        :param fields: names of the fields of the representation (sparse fieldset), None - all of them
+        """
+        self.storage = models.Article._meta.get_field('image').storage
+        self.timestamp = serializers.DateTimeField().to_representation
+        getters = {
+            'id': operator.itemgetter('id'),
+            'author': self.get_author,
+            'image_url': self.get_image_url,
+            'image_srcset': self.get_image_srcset,
+            'title': operator.itemgetter('title'),
+            'description': operator.itemgetter('description'),
+            'timestamp': self.get_timestamp,
+            'external_url': operator.itemgetter('external_url'),
+            'canonical': operator.itemgetter('canonical_id'),
+        }
+        self.getters = [(name, getters[name]) for name in (self.fields if fields is None else fields)]
+
+    @classmethod
+    def get_values(cls, fields=None):
+        """
+        :return tuple: values of the rows the fields are built from - author is joined only for its field
+        """
+        names = cls.fields if fields is None else fields
+        return tuple(dict.fromkeys([*cls.required_values, *(x for name in names for x in cls.field_values[name])]))
+
+    def to_representation(self, row):
+        return {name: get(row) for name, get in self.getters}
+
+    @classmethod
+    def get_flat_fields(cls, fields=None):
+        """
+        Columns of the representation flattened as by CSVRenderer,
+        image_srcset has a column per width also for articles without image
+        """
+        nested = {
+            'author': ['first_name', 'last_name'],
+            'image_srcset': [str(width) for width in settings.NEWS_IMAGE_WIDTHS],
+        }
+        return [
+            f'{name}_{child}' if name in nested else name
+            for name in (cls.fields if fields is None else fields) for child in nested.get(name, [None])
+        ]
+
+    @staticmethod
+    def get_author(row):
+        return {
+            'first_name': row['author__first_name'],
+            'last_name': row['author__last_name'],
+        }
+
+    def get_image_url(self, row):
+        """
+        The same as ArticleSerializer.get_image_url
+        """
+        if row['image']:
+            return self.storage.url(row['image'])
+        if row['external_image_hash']:
+            return images.get_url(row['external_image_hash'], self.storage)
+        return row['external_image']
+
+    @staticmethod
+    def get_image_srcset(row):
+        return images.get_srcset(row['image_hash'] if row['image'] else row['external_image_hash'])
+
+    def get_timestamp(self, row):
+        return self.timestamp(row['timestamp'])
+
+    def to_representation_many(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+
+class IngestJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.IngestJob
+        fields = ('id', 'query', 'period', 'status', 'found', 'new_article_ids', 'error', 'created', 'finished',)
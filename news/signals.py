@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from news import models
+from news.cache import bump_generation
+
+
+@receiver(post_delete, sender=models.Article)
+@receiver(post_delete, sender=models.Author)
+@receiver(post_save, sender=models.Author)
+def invalidate_cached_responses(sender, **kwargs):
+    """
+    Article.save and ingestion invalidate cached responses themselves - after keywords are indexed
+    """
+    bump_generation()
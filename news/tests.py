@@ -1,13 +1,40 @@
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+from PIL import Image
 
-from requests import HTTPError
-from news import models, serializers, views
-from news.utils import NewsApi
-from news.management.commands.get_articles_from_newsapi import Command as GetArticles
+import requests
+from requests import ConnectionError, HTTPError
+from news import analyzer, benchmark, db, duplicates, image_cache, images, jobs, metrics, models, partitions, serializers, \
+    views
+from news.utils import NewsApi, RateLimiter
+from news.management.commands.get_articles_from_newsapi import Command as GetArticles, download_articles
+from news.management.commands.import_articles import iter_json_array
+from news.pagination import estimate_count
+from news.renderers import FastJSONRenderer
+from news import cache as news_cache
 from django.conf import settings
-from django.urls import reverse
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import QuerySet, Sum
+from django.test import override_settings
+from django.urls import NoReverseMatch, reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
 from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 
 ARTICLES = [
     {
@@ -45,6 +72,13 @@ MOCK_IMAGE = (
     b'\x02\x4c\x01\x00\x3b'
 )
 
+
+def make_image(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
 NEWS_API_OPTIONS = {
     "query": 'test',
     "period": 3
@@ -53,16 +87,33 @@ NEWS_API_OPTIONS = {
 pytestmark = pytest.mark.django_db
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
 @pytest.fixture(scope='session')
 def news_api():
     return NewsApi(settings.NEWS_PORTAL_KEY)
 
 
+@pytest.fixture
+def news_api_stub(settings):
+    with benchmark.news_api_stub(ARTICLES) as server:
+        settings.NEWS_API_URL = server.url
+        yield server
+
+
 @pytest.fixture(scope="session")
 def list_articles_url():
     return reverse('articles-list')
 
 
+@pytest.fixture(scope="session")
+def export_url():
+    return reverse('articles-export')
+
+
 @pytest.fixture(scope="session")
 def download_url():
     return reverse('articles-download-articles-from-newsapi')
@@ -78,6 +129,135 @@ class TestArticle:
         article_serialized = serializers.ArticleSerializer(article).data
         assert article_serialized['image_url'] == article_json['urlToImage']
 
+    def test_bulk_create_from_news_api(self, django_assert_max_num_queries):
+        existing, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[0])
+
+        # one more for canonical articles of near-duplicates, two for related articles, one for trending keywords,
+        # two for the savepoint and one for the ingestion lock
+        with django_assert_max_num_queries(14):
+            new_articles = models.Article.objects.bulk_create_from_news_api(ARTICLES + ARTICLES[1:2])
+
+        assert [x.external_url for x in new_articles] == [x['url'] for x in ARTICLES[1:]]
+        assert models.Article.objects.count() == len(ARTICLES)
+        for article in new_articles:
+            assert article.pk is not None
+            assert set(article.keywords.values_list('name', flat=True)) == models.Keyword.extract(
+                article.title, article.description
+            )
+        assert existing.pk not in [x.pk for x in new_articles]
+        assert models.Article.objects.bulk_create_from_news_api(ARTICLES) == []
+
+    def test_bulk_create_is_atomic(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise RuntimeError('Indexing failed')
+
+        monkeypatch.setattr(models.Keyword.objects, 'index', fail)
+        with pytest.raises(RuntimeError):
+            models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        assert not models.Article.objects.exists()
+
+        # the articles are not skipped as known ones once indexing works again
+        monkeypatch.undo()
+        assert len(models.Article.objects.bulk_create_from_news_api(ARTICLES)) == len(ARTICLES)
+
+    def test_near_duplicates(self, django_assert_max_num_queries):
+        original, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[2])
+        syndicated = [
+            {**ARTICLES[2], 'url': 'https://example.com/1', 'title': ARTICLES[2]['title'] + ' - Example News'},
+            {**ARTICLES[1], 'url': 'https://example.com/2'},
+            {**ARTICLES[1], 'url': 'https://example.com/3', 'title': 'The best luxury smartwatches from Louis Vuitton'},
+            # the same text a month later is another story
+            {**ARTICLES[2], 'url': 'https://example.com/4', 'publishedAt': '2022-04-04T18:24:28Z'},
+        ]
+        with django_assert_max_num_queries(15):
+            first, second, third, later = models.Article.objects.bulk_create_from_news_api(syndicated)
+
+        assert first.canonical_id == original.pk
+        assert second.canonical_id is None
+        assert models.Article.objects.get(pk=third.pk).canonical_id == second.pk
+        assert later.canonical_id is None
+        assert set(original.duplicates.all()) == {first}
+
+        # one by one the same
+        article = models.Article.objects.create(
+            title=third.title, description=third.description, author=third.author, timestamp=third.timestamp
+        )
+        assert article.canonical_id == second.pk
+        article.title = 'Short'
+        article.description = ''
+        article.save()
+        assert article.signature is None and article.canonical_id == second.pk
+
+    def test_collapse_duplicates(self, client, list_articles_url):
+        original, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[2])
+        copy, = models.Article.objects.bulk_create_from_news_api([
+            {**ARTICLES[2], 'url': 'https://example.com/1', 'title': ARTICLES[2]['title'] + ' - Example News'},
+        ])
+        # too short to be compared
+        short, = models.Article.objects.bulk_create_from_news_api([{'title': 'Breaking news', 'url': 'https://example.com/2'}])
+        assert copy.canonical_id == original.pk
+        assert short.signature is None and short.canonical_id is None
+
+        ids = [x['id'] for x in client.get(list_articles_url).json()['results']]
+        assert sorted(ids) == sorted([original.pk, copy.pk, short.pk])
+        results = client.get(list_articles_url, {'collapse_duplicates': 'true'}).json()['results']
+        assert sorted(x['id'] for x in results) == sorted([original.pk, short.pk])
+        assert all(x['canonical'] is None for x in results)
+
+    def test_duplicate_signature(self):
+        words = duplicates.get_words(ARTICLES[2]['title'], ARTICLES[2]['content'])
+        edited = duplicates.get_words(ARTICLES[2]['title'] + ' - Reuters', ARTICLES[2]['content'])
+        other = duplicates.get_words(ARTICLES[1]['title'], ARTICLES[1]['content'])
+        assert duplicates.get_similarity(words, edited) > 0.9
+        assert duplicates.get_similarity(words, other) < 0.1
+        assert duplicates.get_similarity(words, set()) == 0
+
+        signature = duplicates.get_signature(words)
+        assert len(signature) == duplicates.BANDS
+        assert set(signature) & set(duplicates.get_signature(edited))
+        assert not set(signature) & set(duplicates.get_signature(other))
+        assert duplicates.get_signature({'too', 'short'}) is None
+
+    def test_get_or_create_many_authors(self):
+        author = models.Author.objects.create(**models.Author.parse_name('Kaitlyn Cimino'))
+        names = [models.Author.parse_name(x['author']) for x in ARTICLES]
+        authors = models.Author.objects.get_or_create_many(names + names)
+
+        assert len(authors) == len(ARTICLES)
+        assert authors[('Kaitlyn', 'Kaitlyn', 'Cimino')] == author
+        assert models.Author.objects.count() == len(ARTICLES)
+
+    def test_reindex_on_text_change(self, django_assert_num_queries):
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[1])
+        assert article.keywords.filter(name='luxury').exists()
+
+        article = models.Article.objects.get(pk=article.pk)
+        article.external_image = 'https://example.com/image.png'
+        with django_assert_num_queries(1):
+            article.save()
+
+        article.title = 'Completely different headline'
+        article.description = 'Nobody talks about watches'
+        article.save()
+        names = set(article.keywords.values_list('name', flat=True))
+        assert names == {'completely', 'different', 'headline', 'nobody', 'talk', 'watch'}
+
+        article.title = 'Oh no'
+        article.description = ''
+        article.save()
+        assert not article.keywords.exists()
+
+    @pytest.mark.parametrize('text,expected', [
+        ('Watch watches watched watching', {'watch'}),
+        ('Companies rallied, banks buying, running', {'company', 'rally', 'bank', 'buy', 'run'}),
+        ("The U.S. and Café's menu", {'cafe', 'menu'}),
+        ('--- ... 42 2022', {'2022'}),
+        ('News: glass classes, analysis of status', {'news', 'glass', 'class', 'analysis', 'status'}),
+        ('Agreed string', {'agreed', 'string'}),
+    ])
+    def test_analyzer(self, text, expected):
+        assert models.Keyword.extract(text) == analyzer.analyze(text) == expected
+
     def test_add_author(self):
         first_name = 'John'
         last_name = 'Appleseed'
@@ -97,11 +277,284 @@ class TestArticle:
         except HTTPError:
             assert True
 
+    def test_news_api_retries(self, news_api_stub):
+        news_api_stub.responses = [
+            (503, {}, {'status': 'error'}),
+            (429, {'Retry-After': '0'}, {'status': 'error'}),
+        ]
+        news_api = NewsApi('key', url=news_api_stub.url, backoff=0)
+        assert len(news_api.get_articles(query='test', period=1)) == len(ARTICLES)
+        assert len(news_api_stub.requests) == 3
+        assert news_api_stub.requests[-1]['apiKey'] == 'key'
+
+    def test_news_api_retries_exhausted(self, news_api_stub):
+        news_api_stub.responses = [(500, {}, {'status': 'error'})] * 2 + [(400, {}, {'status': 'error'})]
+        with pytest.raises(HTTPError):
+            NewsApi('key', url=news_api_stub.url, retries=1, backoff=0).get_articles(query='test')
+        assert len(news_api_stub.requests) == 2
+
+        # client errors are not retried
+        with pytest.raises(HTTPError):
+            NewsApi('key', url=news_api_stub.url, backoff=0).get_articles(query='test')
+        assert len(news_api_stub.requests) == 3
+
+    def test_news_api_connection_error(self):
+        with pytest.raises(ConnectionError):
+            NewsApi('key', url='http://127.0.0.1:9/', retries=1, backoff=0).get_articles(query='test')
+
+    def test_news_api_backoff(self):
+        news_api = NewsApi('key', backoff=1)
+        for attempt in range(10):
+            assert 0 <= news_api.get_delay(attempt) <= min(NewsApi.MAX_BACKOFF, 2 ** attempt)
+
+        response = requests.Response()
+        response.headers['Retry-After'] = '5'
+        assert news_api.get_delay(0, response) == 5
+        response.headers['Retry-After'] = '86400'
+        assert news_api.get_delay(0, response) == NewsApi.MAX_BACKOFF
+        # HTTP date is not supported
+        response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        assert news_api.get_delay(0, response) <= 1
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=20, capacity=2)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: limiter.acquire(), range(6)))
+        # burst of 2 and 4 more at 20 per second
+        assert time.monotonic() - start >= 0.19
+
+    @pytest.mark.parametrize('page_size,max_pages,requests,complete', [
+        (1, None, 3, True),
+        (2, None, 2, True),
+        (1, 2, 2, False),
+        (100, None, 1, True),
+    ])
+    def test_news_api_paging(self, news_api_stub, page_size, max_pages, requests, complete):
+        news_api = NewsApi('key', url=news_api_stub.url, page_size=page_size, max_pages=max_pages)
+        articles, is_complete = news_api.get_all_articles(query='test')
+        assert is_complete == complete
+        assert articles == ARTICLES[:page_size * (max_pages or len(ARTICLES))]
+        assert len(news_api_stub.requests) == requests
+        assert [int(x['page']) for x in news_api_stub.requests] == list(range(1, requests + 1))
+
+    def test_news_api_maximum_results(self, news_api_stub):
+        news_api_stub.responses = [
+            (200, {}, {'status': 'ok', 'totalResults': 10, 'articles': ARTICLES[:1]}),
+            (426, {}, {'status': 'error', 'code': NewsApi.MAXIMUM_RESULTS_REACHED}),
+        ]
+        articles, complete = NewsApi('key', url=news_api_stub.url, page_size=1).get_all_articles(query='test')
+        assert articles == ARTICLES[:1]
+        assert not complete
+
+    def test_ingest_watermark(self, news_api_stub):
+        assert len(download_articles('test', 10000)) == len(ARTICLES)
+        watermark = models.IngestWatermark.objects.get(query='test')
+        assert watermark.published_at == NewsApi.parse_datetime(ARTICLES[0]['publishedAt'])
+        assert str(watermark).startswith('test')
+
+        # next run starts from the newest article already ingested
+        news_api_stub.articles = ARTICLES[:1]
+        assert download_articles('test', 10000) == []
+        assert news_api_stub.requests[-1]['from'] == '2022-03-07T05:54:00'
+
+        # watermark never goes back, outdated watermark is replaced by period
+        models.IngestWatermark.objects.advance('test', ARTICLES[2:])
+        assert models.IngestWatermark.objects.get(query='test').published_at == watermark.published_at
+        download_articles('test', 1)
+        assert 'T' not in news_api_stub.requests[-1]['from']
+
+        # a longer period than the watermark covers is requested whole, then the watermark covers it
+        models.IngestWatermark.objects.advance('test', ARTICLES[2:])
+        download_articles('test', 20000)
+        assert 'T' not in news_api_stub.requests[-1]['from']
+        for period in (20000, 5000):
+            download_articles('test', period)
+            assert news_api_stub.requests[-1]['from'] == '2022-03-07T05:54:00'
+
+        # an unrelated window restarts the covered one
+        models.IngestWatermark.objects.update(published_at=timezone.now() - timezone.timedelta(days=30))
+        models.IngestWatermark.objects.advance('test', ARTICLES[:1], covered_from=timezone.now())
+        assert not models.IngestWatermark.objects.get_from_times(['test'], 20000)
+
+        # articles without publication time do not move the watermark
+        models.IngestWatermark.objects.advance('other', [{'publishedAt': None}])
+        assert not models.IngestWatermark.objects.filter(query='other').exists()
+
+    def test_download_articles_from_stub(self, news_api_stub):
+        new_articles = download_articles('test', 1)
+        assert len(new_articles) == len(ARTICLES)
+        assert news_api_stub.requests[0]['q'] == 'test'
+
     def test_get_articles(self):
         cmd = GetArticles()
         cmd.handle(**NEWS_API_OPTIONS)
         assert models.Article.objects.all().exists()
 
+    def test_get_articles_concurrently(self, monkeypatch):
+        topics = {'swiss': ARTICLES[:1], 'watches': ARTICLES[1:], 'failing': None}
+
+        def get_all_articles(self, query, period=0, from_time=None):
+            time.sleep(0.1)
+            if topics[query] is None:
+                raise HTTPError('failed')
+            return topics[query], True
+
+        monkeypatch.setattr(NewsApi, 'get_all_articles', get_all_articles)
+        out = io.StringIO()
+        with pytest.raises(CommandError, match='failing'):
+            call_command('get_articles_from_newsapi', query='swiss, watches, failing', period=1,
+                         concurrency=3, stdout=out)
+        assert models.Article.objects.count() == len(ARTICLES)
+        assert 'found: 3, added: 3' in out.getvalue()
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_reindex_keywords(self, tmp_path, workers):
+        def index():
+            return {pk: set(models.Article.objects.get(pk=pk).keywords.values_list('name', flat=True)) for pk in ids}
+
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        ids = [x.pk for x in articles]
+        expected = index()
+        # stale keywords (e.g. of an older analyzer) and a missing link
+        obsolete = models.Keyword.objects.create(name='obsolete')
+        articles[0].keywords.add(obsolete)
+        articles[-1].keywords.remove(articles[-1].keywords.first())
+        models.KeywordTrend.objects.all().delete()
+
+        checkpoint = tmp_path / 'checkpoint.json'
+        out = io.StringIO()
+        call_command('reindex_keywords', batch_size=2, workers=workers, checkpoint=str(checkpoint),
+                     delete_orphans=True, stdout=out)
+        assert f'Re-indexed {len(ARTICLES)} articles' in out.getvalue()
+        assert '1 orphaned keywords deleted' in out.getvalue()
+        assert index() == expected
+        assert not models.Keyword.objects.filter(name='obsolete').exists()
+        assert models.KeywordTrend.objects.aggregate(total=Sum('count'))['total'] == \
+            models.Article.keywords.through.objects.count()
+        assert not checkpoint.exists()
+
+        # resumed after the checkpoint, only the articles within the dates
+        articles[0].keywords.clear()
+        articles[-1].keywords.clear()
+        params = {'from_date': '2022-03-01', 'to_date': '2022-03-31', 'batch_size': 2}
+        checkpoint.write_text(json.dumps({'params': params, 'last_id': ids[0]}))
+        call_command('reindex_keywords', workers=workers, checkpoint=str(checkpoint), stdout=out, **params)
+        assert not models.Article.objects.get(pk=ids[0]).keywords.exists()
+        dated = [pk for pk in ids[1:] if models.Article.objects.get(pk=pk).timestamp.month == 3]
+        assert {pk: keywords for pk, keywords in index().items() if pk in dated} == \
+            {pk: expected[pk] for pk in dated}
+
+        checkpoint.write_text(json.dumps({'params': {**params, 'batch_size': 10}, 'last_id': 0}))
+        with pytest.raises(CommandError, match='other parameters'):
+            call_command('reindex_keywords', workers=workers, checkpoint=str(checkpoint), stdout=out, **params)
+        with pytest.raises(CommandError, match='wrong date format'):
+            call_command('reindex_keywords', from_date='March', checkpoint=str(tmp_path / 'other.json'))
+
+    def test_import_articles(self, tmp_path):
+        models.Article.objects.bulk_create_from_news_api(ARTICLES[:1])
+        response = tmp_path / 'articles.json'
+        response.write_text(json.dumps({'status': 'ok', 'totalResults': 3, 'articles': ARTICLES}))
+        dump = tmp_path / 'articles.ndjson.gz'
+        with gzip.open(dump, 'wt') as file:
+            file.write('\n'.join(json.dumps(x) for x in ARTICLES + [{**ARTICLES[0], 'url': 'https://example.com/1'}]))
+
+        out = io.StringIO()
+        call_command('import_articles', str(response), str(dump), batch_size=2, stdout=out)
+        assert 'Read 7 articles, added 3' in out.getvalue()
+        assert models.Article.objects.count() == len(ARTICLES) + 1
+        # near-duplicate of an article of the same batch
+        copy = models.Article.objects.get(external_url='https://example.com/1')
+        assert copy.canonical.external_url == ARTICLES[0]['url']
+        assert copy.signature == models.Article.objects.get(external_url=ARTICLES[0]['url']).signature
+
+        article = models.Article.objects.get(external_url=ARTICLES[2]['url'])
+        assert article.author.username == 'info@hypebeast.com'
+        assert article.timestamp == NewsApi.parse_datetime(ARTICLES[2]['publishedAt'])
+        assert set(article.keywords.values_list('name', flat=True)) == set(
+            models.Keyword.extract(article.title, article.description))
+        assert models.Article.objects.filter(search_vector__isnull=True).count() == 0
+        assert models.Author.objects.count() == len(ARTICLES)
+        # every keyword link is counted in the trends
+        assert models.KeywordTrend.objects.aggregate(total=Sum('count'))['total'] == \
+            models.Article.keywords.through.objects.count()
+
+    def test_article_partitions(self):
+        def get_partition(article):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT tableoid::regclass::text FROM news_article WHERE id = %s', [article.pk])
+                return cursor.fetchone()[0]
+
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[0])
+        assert get_partition(article) == partitions.DEFAULT_PARTITION
+
+        out = io.StringIO()
+        call_command('create_article_partitions', months=1, stdout=out)
+        assert 'news_article_p202203' in out.getvalue()
+        assert get_partition(article) == 'news_article_p202203'
+        current = partitions.get_month(timezone.now())
+        with connection.cursor() as cursor:
+            assert {current, partitions.add_months(current, 1), datetime.date(2022, 3, 1)} <= set(
+                partitions.get_partitions(cursor))
+        # the newest article is in the partition of its month, updates move articles between partitions
+        article.timestamp = timezone.now()
+        article.save()
+        assert get_partition(article) == partitions.get_name(current)
+
+        call_command('create_article_partitions', months=1, stdout=out)
+        assert out.getvalue().endswith('Partitions created: none\n')
+
+    def test_archive_articles(self, tmp_path):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        old = [x for x in articles if x.timestamp.year == 2022]
+        new, = [x for x in articles if x.timestamp.year > 2022]
+        models.Article.objects.filter(pk=new.pk).update(canonical=old[0])
+        models.RelatedArticle.objects.create(article=new, related=old[0], score=1)
+
+        out = io.StringIO()
+        call_command('archive_articles', months=12, path=str(tmp_path), stdout=out)
+        assert 'news_article_p202203: 2 articles archived' in out.getvalue()
+        assert 'Archived 2 articles of 1 months before' in out.getvalue()
+        assert list(models.Article.objects.values_list('id', flat=True)) == [new.pk]
+        assert models.Article.objects.get(pk=new.pk).canonical is None
+        assert not models.RelatedArticle.objects.filter(related__in=[x.pk for x in old]).exists()
+        assert models.Article.keywords.through.objects.exclude(article_id=new.pk).count() == 0
+        assert models.KeywordTrend.objects.filter(bucket__year=2022).count() == 0
+        with connection.cursor() as cursor:
+            assert datetime.date(2022, 3, 1) not in partitions.get_partitions(cursor)
+
+        with gzip.open(tmp_path / 'news_article_p202203.ndjson.gz', 'rt') as file:
+            archived = [json.loads(line) for line in file]
+        assert [x['url'] for x in archived] == [ARTICLES[2]['url'], ARTICLES[0]['url']]
+        assert archived[1]['author'] is None
+        assert archived[0]['author'] == ARTICLES[2]['author']
+        assert archived[0]['publishedAt'] == ARTICLES[2]['publishedAt']
+
+        # archives are loaded back as they are
+        call_command('import_articles', str(tmp_path / 'news_article_p202203.ndjson.gz'), stdout=out)
+        restored = models.Article.objects.get(external_url=ARTICLES[0]['url'])
+        assert (restored.title, restored.description, restored.timestamp) == (old[0].title, old[0].description,
+                                                                              old[0].timestamp)
+
+        call_command('archive_articles', months=12, path=str(tmp_path), stdout=out)
+        assert 'Archived 2 articles of 1 months' in out.getvalue().splitlines()[-1]
+        with pytest.raises(CommandError, match='Retention is not set'):
+            call_command('archive_articles', months=0, path=str(tmp_path))
+
+    @pytest.mark.parametrize('document', [ARTICLES, {'status': 'ok', 'articles': ARTICLES}])
+    def test_iter_json_array(self, document):
+        file = io.StringIO(json.dumps(document, indent=2))
+        expected = document['articles'] if isinstance(document, dict) else document
+        assert list(iter_json_array(file, chunk_size=7)) == expected
+
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.StringIO(json.dumps(document)[:-30]), chunk_size=7))
+
+    @pytest.mark.parametrize('text', ['{"status": "ok"}', '{"status": "ok", "articles"'])
+    def test_iter_json_array_invalid(self, text):
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.StringIO(text), chunk_size=7))
+
 
 class TestArticleView:
     def test_get_all_articles(self, client, list_articles_url):
@@ -119,6 +572,148 @@ class TestArticleView:
         for k in keywords.split(','):
             assert k in data['title'].lower() or k in data['description'].lower()
 
+    @pytest.mark.parametrize('keywords,mode,expected', [
+        ('watches,auction,michael', None, [2]),
+        ('watches,auction,spare', 'all', []),
+        ('auction,spare', 'any', [1, 2]),
+        # other forms of the words, stopwords only
+        ('Watched,AUCTIONS,michael', None, [2]),
+        ('the,about', 'any', []),
+    ])
+    def test_keywords_mode(self, client, list_articles_url, keywords, mode, expected, django_assert_max_num_queries):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        params = {'keywords': keywords}
+        if mode:
+            params['keywords_mode'] = mode
+
+        with django_assert_max_num_queries(2):
+            response = client.get(list_articles_url, params)
+        assert response.status_code == 200
+        assert sorted(x['id'] for x in response.json()['results']) == [articles[i].id for i in expected]
+
+    def test_related_articles(self, client, django_assert_num_queries):
+        texts = [
+            'Gold prices rally as central banks keep buying bullion',
+            'Central banks buying gold at record pace',
+            'Football season opens with record crowds',
+            'Gold medal for football team',
+            'Weather forecast sunny weekend everywhere',
+        ]
+        articles = models.Article.objects.bulk_create_from_news_api([
+            {'title': text, 'url': f'https://example.com/{i}', 'publishedAt': f'2022-03-0{i + 1}T00:00:00Z'}
+            for i, text in enumerate(texts)
+        ])
+        gold, banks, football, medal, weather = articles
+        url = reverse('articles-related', args=[gold.pk])
+
+        with django_assert_num_queries(1):
+            response = client.get(url)
+        assert response.status_code == 200
+        related = response.json()
+        # 'central banks buying' outweighs 'gold' shared by the both
+        assert [x['id'] for x in related] == [banks.pk, medal.pk]
+        assert related[0]['score'] > related[1]['score'] > 0
+        row = models.Article.objects.values(*serializers.ArticleRowSerializer.get_values()).get(pk=banks.pk)
+        assert {k: v for k, v in related[0].items() if k != 'score'} == serializers.ArticleRowSerializer(
+        ).to_representation(row)
+
+        assert [x['id'] for x in client.get(url, {'limit': 1}).json()] == [banks.pk]
+        assert client.get(reverse('articles-related', args=[weather.pk])).json() == []
+        assert client.get(reverse('articles-related', args=[0])).status_code == 404
+        assert client.get(url, {'limit': 'all'}).status_code == 400
+        assert client.get(url, {'limit': 0}).status_code == 400
+        link = models.RelatedArticle.objects.filter(article=gold).first()
+        assert str(link) == f'{gold.pk} - {banks.pk}: {link.score:.2f}'
+
+        with django_assert_num_queries(0):
+            models.RelatedArticle.objects.refresh([])
+
+        # new article is offered as related to the existing ones, only the best NEWS_RELATED_COUNT are kept
+        with override_settings(NEWS_RELATED_COUNT=2):
+            models.Article.objects.create(title='Football crowds cheer the gold team', author=gold.author)
+        assert models.RelatedArticle.objects.filter(article=football).count() == 2
+        assert models.RelatedArticle.objects.filter(article=medal).count() == 2
+
+        # re-indexed article leaves related articles it has nothing in common with any more
+        medal.title = 'Weather sunny'
+        medal.save()
+        assert not models.RelatedArticle.objects.filter(related=medal).exclude(article=weather).exists()
+        assert set(models.RelatedArticle.objects.filter(article=medal).values_list('related', flat=True)) == {
+            weather.pk
+        }
+
+        models.RelatedArticle.objects.all().delete()
+        out = io.StringIO()
+        call_command('build_related_articles', batch_size=2, stdout=out)
+        assert 'Related articles of 6 articles' in out.getvalue()
+        assert [x['id'] for x in client.get(url).json()][:1] == [banks.pk]
+        assert models.RelatedArticle.objects.filter(article=weather).count() == 1
+
+    def test_trending_keywords(self, client, django_assert_num_queries):
+        def trends():
+            return {(name, bucket): count for name, bucket, count in
+                    models.KeywordTrend.objects.values_list('keyword__name', 'bucket', 'count')}
+
+        now = timezone.now()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        texts = [
+            ('Gold prices rally', now),
+            ('Gold medal for football team', now - datetime.timedelta(hours=3)),
+            ('Football season opens', now - datetime.timedelta(days=3)),
+            ('Football fans', now - datetime.timedelta(days=30)),
+        ]
+        prices, medal, season, fans = models.Article.objects.bulk_create_from_news_api([
+            {'title': text, 'url': f'https://example.com/{i}', 'publishedAt': timestamp.strftime(NewsApi.DATETIME_FORMAT)}
+            for i, (text, timestamp) in enumerate(texts)
+        ])
+        assert trends()[('gold', hour)] == 1
+        assert trends()[('football', hour - datetime.timedelta(hours=3))] == 1
+        assert str(models.KeywordTrend.objects.get(keyword__name='price')).endswith(': 1')
+
+        url = reverse('articles-trending')
+        with django_assert_num_queries(1):
+            response = client.get(url)
+        assert response.status_code == 200
+        assert response.json()[:2] == [{'keyword': 'gold', 'articles': 2}, {'keyword': 'football', 'articles': 1}]
+        assert client.get(url, {'period': 'hour'}).json()[0] == {'keyword': 'gold', 'articles': 1}
+        assert client.get(url, {'period': 'week', 'limit': 1}).json() == [{'keyword': 'football', 'articles': 2}]
+        assert client.get(url, {'period': 'month'}).status_code == 400
+        assert client.get(url, {'limit': 'all'}).status_code == 400
+        assert client.get(url, {'limit': 0}).status_code == 400
+
+        # re-indexed and moved articles are counted once - under the new keywords and hour
+        medal.title = 'Gold rush'
+        medal.timestamp = now
+        medal.save()
+        assert trends()[('gold', hour)] == 2
+        assert trends()[('rush', hour)] == 1
+        assert not any(name == 'football' and bucket > hour - datetime.timedelta(days=1) for name, bucket in trends())
+
+        # articles are taken out of the trends on delete, empty rows are deleted
+        prices.delete()
+        models.Article.objects.filter(pk=season.pk).delete()
+        assert trends()[('gold', hour)] == 1
+        assert ('price', hour) not in trends()
+        assert not any(bucket == hour - datetime.timedelta(days=3) for _, bucket in trends())
+        with django_assert_num_queries(0):
+            models.KeywordTrend.objects.remove([])
+
+        # drift (e.g. articles deleted with their author) is repaired by the command
+        expected = trends()
+        models.KeywordTrend.objects.filter(keyword__name='fans').update(count=5)
+        models.KeywordTrend.objects.filter(keyword__name='rush').delete()
+        out = io.StringIO()
+        call_command('build_keyword_trends', days=7, stdout=out)
+        assert 'Trending keywords of the last 7 days: 2 rows' in out.getvalue()
+        assert trends() == {**expected, ('fans', fans.timestamp.replace(minute=0, second=0, microsecond=0)): 5}
+        call_command('build_keyword_trends', stdout=out)
+        assert 'Trending keywords of all articles: 4 rows' in out.getvalue()
+        assert trends() == expected
+
+    def test_wrong_keywords_mode(self, client, list_articles_url):
+        response = client.get(list_articles_url, {'keywords': 'watches', 'keywords_mode': 'some'})
+        assert response.status_code == 400
+
     def test_no_keyword(self, client, list_articles_url):
         response = client.get(
             list_articles_url, {'keywords': 'for_sure_no_such_word'}
@@ -163,6 +758,247 @@ class TestArticleView:
         assert article_1.id in ids
         assert article_2.id not in ids
 
+    def test_search(self, client, list_articles_url):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+
+        response = client.get(list_articles_url, {'search': 'rolex auction'})
+        assert [x['id'] for x in response.json()['results']] == [articles[2].id]
+
+        # stemmed match in title of the first article ranks above the one in description
+        response = client.get(list_articles_url, {'search': 'watch'})
+        assert [x['id'] for x in response.json()['results']] == [articles[0].id, articles[2].id]
+
+        response = client.get(list_articles_url, {'search': 'watch', 'ordering': 'timestamp'})
+        assert [x['id'] for x in response.json()['results']] == [articles[2].id, articles[0].id]
+
+    def test_search_vector_update(self, client, list_articles_url):
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[0])
+        article.title = 'Zurich exchange closes early'
+        article.save()
+
+        response = client.get(list_articles_url, {'search': 'exchange'})
+        assert [x['id'] for x in response.json()['results']] == [article.id]
+
+    def test_cursor_pagination(self, client, list_articles_url):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        # equal timestamps are ordered by id
+        models.Article.objects.filter(pk=articles[0].pk).update(timestamp=articles[2].timestamp)
+
+        ids = []
+        url, params = list_articles_url, {'cursor': '', 'limit': 1}
+        while url:
+            data = client.get(url, params).json()
+            assert data['count'] is None
+            assert data['previous'] is None
+            ids += [x['id'] for x in data['results']]
+            url, params = data['next'], None
+        assert ids == [x.id for x in models.Article.objects.order_by('-timestamp', '-id')]
+        assert len(ids) == len(ARTICLES)
+
+    @pytest.mark.parametrize('params,status_code', [
+        ({'cursor': 'not-a-cursor'}, 404),
+        ({'cursor': '', 'ordering': 'title'}, 400),
+        ({'count': 'sometimes'}, 400),
+    ])
+    def test_cursor_pagination_negative(self, client, list_articles_url, params, status_code):
+        response = client.get(list_articles_url, params)
+        assert response.status_code == status_code
+
+    @pytest.mark.parametrize('params', [
+        {'count': 'none'},
+        {'count': 'estimate'},
+        {'count': 'estimate', 'keywords': 'auction,spare', 'keywords_mode': 'any'},
+        {'count': 'exact', 'cursor': ''},
+    ])
+    def test_count_modes(self, client, list_articles_url, params):
+        models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        data = client.get(list_articles_url, {'limit': 1, **params}).json()
+        assert len(data['results']) == 1
+        assert data['next'] is not None
+        if params['count'] == 'none':
+            assert data['count'] is None
+        else:
+            assert isinstance(data['count'], int)
+
+        data = client.get(list_articles_url, {'limit': 10, **params}).json()
+        assert data['next'] is None
+
+    def test_estimate_count_from_statistics(self):
+        models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE news_article')
+        assert estimate_count(models.Article.objects.all()) == len(ARTICLES)
+
+    @pytest.mark.parametrize('params', [
+        {},
+        {'limit': 2, 'offset': 1},
+        {'ordering': 'title'},
+        {'search': 'watches'},
+        {'keywords': 'auction,spare', 'keywords_mode': 'any'},
+        {'cursor': '', 'limit': 2},
+        {'format': 'json'},
+        {'fields': 'id,author,image_srcset'},
+        {'omit': 'description,author', 'cursor': ''},
+    ])
+    def test_fast_list_is_compatible(self, client, list_articles_url, monkeypatch, params):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        articles[0].image = SimpleUploadedFile(name='test_image.gif', content=MOCK_IMAGE, content_type='image/gif')
+        articles[0].description += ' \u2028 separated \u2029 paragraphs\n\t"quoted" – ünïcödé 😀'
+        articles[0].save()
+        models.Article.objects.filter(pk=articles[2].pk).update(external_image_hash='a' * 64)
+
+        fast = client.get(list_articles_url, params)
+        cache.clear()
+        monkeypatch.setattr(views.ArticleViewSet, 'fast_list', False)
+        monkeypatch.setattr(views.ArticleViewSet, 'renderer_classes', [JSONRenderer])
+        slow = client.get(list_articles_url, params)
+
+        assert fast.status_code == slow.status_code == 200
+        assert fast.content == slow.content
+        assert len(fast.json()['results']) > 0
+
+    @pytest.mark.parametrize('data', [
+        {'decimal': Decimal('1.10'), 'time': timezone.now(), 'text': 'line\u2028separator', 'nested': [1, None, True]},
+        None,
+    ])
+    @pytest.mark.parametrize('media_type', ['application/json', 'application/json; indent=4'])
+    def test_fast_json_renderer(self, data, media_type):
+        assert FastJSONRenderer().render(data, media_type) == JSONRenderer().render(data, media_type)
+
+    @pytest.mark.parametrize('params', [
+        {},
+        {'keywords': 'auction,spare', 'keywords_mode': 'any'},
+        {'from_date': '2022-03-05'},
+    ])
+    def test_export_ndjson(self, client, list_articles_url, export_url, params):
+        models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        response = client.get(export_url, params)
+        assert response.status_code == 200
+        assert response.streaming
+        assert response['Content-Type'] == 'application/x-ndjson'
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert [json.loads(x) for x in lines] == client.get(list_articles_url, params).json()['results']
+
+    def test_export_csv(self, client, list_articles_url, export_url, settings):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        # the newest article - the first row - has no image, an older one has a local copy of its image
+        models.Article.objects.filter(pk=articles[2].pk).update(external_image_hash='a' * 64)
+        for response in [client.get(export_url, {'format': 'csv'}), client.get(export_url, HTTP_ACCEPT='text/csv')]:
+            assert response['Content-Type'].startswith('text/csv')
+            content = b''.join(response.streaming_content).decode()
+            rows = list(csv.DictReader(io.StringIO(content)))
+            results = client.get(list_articles_url).json()['results']
+            assert [int(x['id']) for x in rows] == [x['id'] for x in results]
+            assert rows[0]['author_last_name'] == results[0]['author']['last_name']
+            assert rows[0]['description'] == results[0]['description']
+            assert list(rows[0]) == serializers.ArticleRowSerializer.get_flat_fields()
+            assert rows[0]['id'] != str(articles[2].pk)
+            with_image = next(x for x in rows if x['id'] == str(articles[2].pk))
+            assert with_image['image_srcset_640'] == images.get_srcset('a' * 64)['640']
+            assert all(x['image_srcset_640'] == '' for x in rows if x is not with_image)
+
+    def test_sparse_fieldsets(self, client, list_articles_url, export_url, django_assert_num_queries):
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        detail_url = reverse('articles-detail', args=[articles[0].pk])
+
+        # only the columns of the fields are read, author is joined only for its field
+        with django_assert_num_queries(2) as captured:
+            results = client.get(list_articles_url, {'fields': 'title, id'}).json()['results']
+        assert [*results[0]] == ['id', 'title']
+        assert 'news_author' not in captured.captured_queries[-1]['sql']
+        assert '"description"' not in captured.captured_queries[-1]['sql']
+
+        with django_assert_num_queries(1) as captured:
+            article = client.get(detail_url, {'omit': 'author,description'}).json()
+        assert [*article] == ['id', 'image_url', 'image_srcset', 'title', 'timestamp', 'external_url', 'canonical']
+        assert 'news_author' not in captured.captured_queries[0]['sql']
+        assert '"description"' not in captured.captured_queries[0]['sql']
+        with django_assert_num_queries(1):
+            assert client.get(detail_url, {'fields': 'author'}).json() == {
+                'author': serializers.AuthorSerializer(articles[0].author).data
+            }
+
+        related = client.get(reverse('articles-related', args=[articles[0].pk]), {'fields': 'title'}).json()
+        assert all([*x] == ['title', 'score'] for x in related)
+
+        response = client.get(export_url, {'format': 'csv', 'fields': 'id,author', 'omit': 'id'})
+        content = b''.join(response.streaming_content).decode()
+        assert content.splitlines()[0] == 'author_first_name,author_last_name'
+
+        # updates are not affected
+        response = client.patch(detail_url, {'title': 'New title'}, content_type='application/json')
+        assert response.json()['description'] == articles[0].description
+
+        for params in [{'fields': 'id,body'}, {'omit': 'id,body'}, {'fields': 'id', 'omit': 'id'}]:
+            response = client.get(list_articles_url, params)
+            assert response.status_code == 400
+            assert client.get(detail_url, params).status_code == 400
+
+    @pytest.mark.parametrize('params', [{'format': 'csv'}, {'format': 'ndjson'}, {'format': 'json'}])
+    def test_export_negative(self, client, export_url, params):
+        response = client.get(export_url, {'from_date': '2022-31-31', **params})
+        assert response.status_code == 400
+        assert 'wrong date format' in response.content.decode()
+
+    def test_cached_response(self, client, list_articles_url, django_assert_num_queries, settings,
+                             django_capture_on_commit_callbacks):
+        settings.NEWS_CACHE_TIMEOUT = 300
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[0])
+        detail_url = reverse('articles-detail', args=[article.id])
+        params = {'keywords': 'swiss,stocks', 'limit': 10}
+
+        data = client.get(list_articles_url, params).json()
+        client.get(detail_url)
+        with django_assert_num_queries(0):
+            # order of parameters does not matter
+            assert client.get(list_articles_url, dict(reversed(params.items()))).json() == data
+            assert client.get(detail_url).json()['title'] == article.title
+
+        # cached responses are invalidated once the write is committed - not while it can still be read as it was
+        with django_capture_on_commit_callbacks(execute=True):
+            article.title = 'Swiss stocks - new title'
+            article.save()
+            assert client.get(detail_url).json()['title'] != article.title
+        assert client.get(list_articles_url, params).json()['results'][0]['title'] == article.title
+        assert client.get(detail_url).json()['title'] == article.title
+
+        with django_capture_on_commit_callbacks(execute=True):
+            models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        assert client.get(list_articles_url, params).json()['count'] == 1
+        assert client.get(list_articles_url).json()['count'] == len(ARTICLES)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            article.delete()
+        assert client.get(detail_url).status_code == 404
+        assert client.get(list_articles_url, params).json()['count'] == 0
+
+    def test_cache_stampede(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'data', True
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: news_cache.get_or_compute('key', compute, 10), range(5)))
+        assert results == ['data'] * 5
+        assert len(calls) == 1
+
+    def test_cache_lock_timeout(self, monkeypatch):
+        monkeypatch.setattr(news_cache, 'LOCK_TIMEOUT', 0)
+        cache.add('key:lock', 1)
+        # the lock is held by a computation that takes too long - the data is computed without caching
+        assert news_cache.get_or_compute('key', lambda: ('data', True), 10) == 'data'
+        assert cache.get('key') is None
+
+    def test_cache_generation_lost(self):
+        generation = news_cache.get_generation()
+        cache.delete(news_cache.GENERATION_KEY)
+        news_cache.increment_generation()
+        assert news_cache.get_generation() > generation
+
     def test_image_url(self, client, list_articles_url):
         test_image_name = 'test_image'
         article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[1])
@@ -172,15 +1008,239 @@ class TestArticleView:
         assert article_serialized['image_url'] != ARTICLES[1]['urlToImage']
         assert test_image_name in article_serialized['image_url']
 
+    def test_image_derivatives(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        content = make_image(2000, 1000)
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[1])
+        article.image = SimpleUploadedFile(name='large.png', content=content, content_type='image/png')
+        article.save()
+
+        srcset = serializers.ArticleSerializer(article).data['image_srcset']
+        assert list(srcset) == ['320', '640', '1280']
+        for width, url in srcset.items():
+            with Image.open(tmp_path / url[len(settings.MEDIA_URL):]) as image:
+                assert image.format == 'WEBP'
+                assert image.size == (int(width), int(width) // 2)
+
+        # the same content is resized once
+        other, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[2])
+        other.image = SimpleUploadedFile(name='copy.png', content=content, content_type='image/png')
+        other.save()
+        assert serializers.ArticleSerializer(other).data['image_srcset'] == srcset
+        assert len(list(tmp_path.glob(f'{images.DIRECTORY}/*/*/*'))) == 3
+
+        other.image = None
+        other.save()
+        assert serializers.ArticleSerializer(other).data['image_srcset'] is None
+
+    def test_lazy_image_derivatives(self, client, list_articles_url, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.NEWS_IMAGE_EAGER = False
+        article, _ = models.Article.objects.get_or_create_from_news_api(**ARTICLES[1])
+        article.image = SimpleUploadedFile(name='small.gif', content=MOCK_IMAGE, content_type='image/gif')
+        article.save()
+        assert not (tmp_path / images.DIRECTORY).exists()
+
+        srcset = client.get(list_articles_url).json()['results'][0]['image_srcset']
+        for _ in range(2):
+            response = client.get(srcset['640'])
+            assert response.status_code == 302
+            assert 'immutable' in response['Cache-Control']
+        assert response.url == f'{settings.MEDIA_URL}{images.get_name(article.image_hash, 640)}'
+        # smaller images are not upscaled
+        with Image.open(tmp_path / images.get_name(article.image_hash, 640)) as image:
+            assert image.size == (1, 1)
+
+        assert client.get(srcset['640'].replace('640', '100')).status_code == 404
+        assert client.get(reverse('articles-image', args=['0' * 64, 640])).status_code == 404
+
+    def test_cache_external_images(self, news_api_stub, settings, tmp_path, monkeypatch):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.NEWS_IMAGE_CACHE_EAGER = True
+        content = make_image(1600, 900)
+        downloads = []
+
+        def download(url):
+            downloads.append(url)
+            if url == ARTICLES[0]['urlToImage']:
+                raise ConnectionError('Connection refused')
+            return content
+
+        monkeypatch.setattr(image_cache, 'download', download)
+        new_articles = download_articles('test', 1)
+        assert len(downloads) == len(ARTICLES)
+
+        failed, cached, other = [serializers.ArticleSerializer(models.Article.objects.get(pk=x.pk)).data
+                                 for x in new_articles]
+        assert failed['image_url'] == ARTICLES[0]['urlToImage']
+        assert failed['image_srcset'] is None
+        # images of equal content share the local copy
+        assert cached['image_url'] == other['image_url'] == cached['image_srcset']['1280']
+        assert cached['image_url'].startswith(f'{settings.MEDIA_URL}{images.DIRECTORY}/')
+        assert len(list(tmp_path.glob(f'{images.DIRECTORY}/*/*/*'))) == len(settings.NEWS_IMAGE_WIDTHS)
+
+        statuses = dict(models.CachedImage.objects.values_list('url', 'status'))
+        assert statuses[ARTICLES[0]['urlToImage']] == models.CachedImage.FAILED
+        assert statuses[ARTICLES[1]['urlToImage']] == models.CachedImage.DONE
+        assert str(models.CachedImage.objects.first()).startswith('http')
+
+        # every URL is downloaded once, failed ones - only on request
+        models.Article.objects.update(external_image_hash='')
+        out = io.StringIO()
+        call_command('cache_external_images', workers=1, stdout=out)
+        assert 'cached: 2, failed: 1' in out.getvalue()
+        assert len(downloads) == len(ARTICLES)
+
+        call_command('cache_external_images', workers=1, retry_failed=True, stdout=out)
+        assert downloads[-1] == ARTICLES[0]['urlToImage']
+
+    @pytest.mark.django_db(transaction=True)
+    def test_cache_external_images_in_background(self, settings, tmp_path, monkeypatch, caplog):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.NEWS_IMAGE_CACHE_QUEUE = 2
+        caplog.set_level(logging.INFO, logger='news.image_cache')
+        monkeypatch.setattr(image_cache, '_executor', None)
+        monkeypatch.setattr(image_cache, '_queue', None)
+        release = threading.Event()
+        content = make_image(800, 450)
+        cache_image = image_cache.cache_image
+
+        def download(url):
+            return content
+
+        def cache_or_fail(url, article_ids):
+            # downloads wait until all of them are submitted
+            release.wait(5)
+            if url == ARTICLES[1]['urlToImage']:
+                raise RuntimeError('Storage is not available')
+            return cache_image(url, article_ids)
+
+        monkeypatch.setattr(image_cache, 'download', download)
+        monkeypatch.setattr(image_cache, 'cache_image', cache_or_fail)
+        articles = models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        image_cache.submit(articles)
+        release.set()
+        image_cache.get_executor().shutdown(wait=True)
+
+        cached, failed, skipped = [models.Article.objects.get(pk=x.pk).external_image_hash for x in articles]
+        assert cached == hashlib.sha256(content).hexdigest()
+        assert failed == skipped == ''
+        assert f'Failed to cache image {ARTICLES[1]["urlToImage"]}' in caplog.text
+        assert f'{ARTICLES[2]["urlToImage"]} is skipped' in caplog.text
+
+    def test_download_image(self, news_api_stub, settings):
+        assert json.loads(image_cache.download(news_api_stub.url))['status'] == 'ok'
+        settings.NEWS_IMAGE_CACHE_MAX_SIZE = 100
+        with pytest.raises(ValueError):
+            image_cache.download(news_api_stub.url)
+
     def test_wrong_date_format(self, client, list_articles_url):
         response = client.get(
             list_articles_url, {'from_date': '2022-31-31'}
         )
         assert response.status_code == 400
 
-    def test_api_of_articles(self, client, download_url):
+    def test_api_of_articles(self, client, download_url, news_api_stub, settings):
+        settings.NEWS_INGEST_JOBS_EAGER = True
         response = client.get(download_url, {'query': 'test', 'period': 2})
+        assert response.status_code == 202
+        job = response.json()
+        assert job['status'] == models.IngestJob.DONE
+        assert job['found'] == len(ARTICLES)
+
+        response = client.get(reverse('articles-download-job', args=[job['id']]))
         assert response.status_code == 200
+        assert sorted(response.json()['new_article_ids']) == sorted(models.Article.objects.values_list('id', flat=True))
+
+    def test_api_of_articles_failed(self, client, download_url, news_api_stub, settings):
+        settings.NEWS_INGEST_JOBS_EAGER = True
+        news_api_stub.responses = [(401, {}, {'status': 'error', 'code': 'apiKeyInvalid'})]
+        job = client.get(download_url, {'query': 'test', 'period': 2}).json()
+        assert job['status'] == models.IngestJob.FAILED
+        assert 'apiKeyInvalid' in job['error']
+
+        # failed job does not block new ones
+        job_2, created = models.IngestJob.objects.enqueue('test', 2)
+        assert created
+        assert job_2.pk != job['id']
+
+    @pytest.mark.django_db(transaction=True)
+    def test_ingest_job_in_background(self, client, download_url, news_api_stub, settings, monkeypatch):
+        settings.NEWS_IMAGE_CACHE = False
+        monkeypatch.setattr(jobs, '_executor', None)
+        job = client.get(download_url, {'query': 'test', 'period': 2}).json()
+        jobs.get_executor().shutdown(wait=True)
+
+        job = client.get(reverse('articles-download-job', args=[job['id']])).json()
+        assert job['status'] == models.IngestJob.DONE
+        assert len(job['new_article_ids']) == len(ARTICLES)
+
+    @pytest.mark.django_db(transaction=True)
+    def test_concurrent_ingestion(self):
+        def ingest(articles):
+            try:
+                return len(models.Article.objects.bulk_create_from_news_api(articles))
+            finally:
+                connection.close()
+
+        # overlapping batches are written one after another - every URL is saved once
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            added = list(executor.map(ingest, [ARTICLES, ARTICLES[1:], ARTICLES[::-1], ARTICLES[:1]]))
+        assert sum(added) == len(ARTICLES)
+        assert models.Article.objects.count() == len(ARTICLES)
+
+    def test_ingest_job_created_concurrently(self, monkeypatch):
+        competitor, _ = models.IngestJob.objects.enqueue('test', 2)
+        first = QuerySet.first
+        lookups = []
+
+        def first_before_commit(queryset):
+            lookups.append(1)
+            # the competing job is not committed yet when it's looked up the first time
+            return None if len(lookups) == 1 else first(queryset)
+
+        monkeypatch.setattr(QuerySet, 'first', first_before_commit)
+        assert models.IngestJob.objects.enqueue('test', 2) == (competitor, False)
+        monkeypatch.undo()
+
+        create = models.IngestJobManager.create
+        attempts = []
+
+        def create_after_competitor(manager, **kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                # the competing job was active at the insert and finished before the next lookup
+                raise IntegrityError('duplicate key value violates unique constraint')
+            return create(manager, **kwargs)
+
+        monkeypatch.setattr(models.IngestJobManager, 'create', create_after_competitor)
+        models.IngestJob.objects.update(status=models.IngestJob.DONE)
+        job, created = models.IngestJob.objects.enqueue('test', 2)
+        assert created
+        assert len(attempts) == 2
+
+    def test_ingest_jobs_merged(self, client, download_url, monkeypatch):
+        monkeypatch.setattr(jobs, 'submit', lambda job: None)
+        ids = {client.get(download_url, {'query': 'test', 'period': 2}).json()['id'] for _ in range(3)}
+        assert len(ids) == 1
+        assert client.get(download_url, {'query': 'test', 'period': 3}).json()['id'] not in ids
+
+        assert str(models.IngestJob.objects.get(pk=ids.pop())) == 'test (2 days): queued'
+
+    def test_ingest_job_timed_out(self, settings):
+        job, _ = models.IngestJob.objects.enqueue('test', 2)
+        models.IngestJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timezone.timedelta(hours=1))
+        new_job, created = models.IngestJob.objects.enqueue('test', 2)
+        assert created
+        assert models.IngestJob.objects.get(pk=job.pk).status == models.IngestJob.FAILED
+
+        # a timed out job is not picked by the worker any more
+        jobs.run(job.pk)
+        assert models.IngestJob.objects.get(pk=job.pk).status == models.IngestJob.FAILED
+
+    def test_ingest_job_not_found(self, client):
+        response = client.get(reverse('articles-download-job', args=[0]))
+        assert response.status_code == 404
 
     @pytest.mark.parametrize('params', [
         {},
@@ -190,3 +1250,193 @@ class TestArticleView:
     def test_api_of_articles_negative(self, client, download_url, params):
         response = client.get(download_url, params)
         assert response.status_code == 400
+
+
+class TestBenchmark:
+    def test_corpus(self):
+        corpus = benchmark.Corpus(seed=1, vocabulary_size=1000)
+        articles = list(corpus.articles(200))
+        assert articles == list(benchmark.Corpus(seed=1, vocabulary_size=1000).articles(200))
+        assert len(set(corpus.words)) == len(corpus.words)
+
+        # the most frequent word is far more frequent than a word in the tail
+        words = ' '.join(x['title'] + ' ' + x['description'] for x in articles).lower().split()
+        assert words.count(corpus.words[0]) > 10 * words.count(corpus.words[500]) + 10
+
+    def test_benchmark(self, tmp_path):
+        baseline = tmp_path / 'benchmark.json'
+        options = {'size': 300, 'repeat': 2, 'ingest_size': 150, 'baseline': str(baseline), 'in_place': True}
+        out = io.StringIO()
+        call_command('benchmark', stdout=out, **options)
+        assert 'Baseline is saved' in out.getvalue()
+
+        results = json.loads(baseline.read_text())
+        assert results['meta']['size'] == 300
+        assert results['scenarios']['list']['queries'] == 2   # count and page
+        assert all(x['queries'] > 0 for x in results['scenarios'].values())
+
+        # every query is counted as regression
+        for result in results['scenarios'].values():
+            result['queries'] -= 1
+            result['median_ms'] = 1000
+        baseline.write_text(json.dumps(results))
+        with pytest.raises(CommandError, match='queries instead of'):
+            call_command('benchmark', stdout=out, **options)
+
+        # slower baseline with the same queries
+        for result in results['scenarios'].values():
+            result['queries'] += 1
+        baseline.write_text(json.dumps(results))
+        call_command('benchmark', stdout=out, **options)
+        assert 'No regressions against' in out.getvalue()
+
+        with pytest.raises(CommandError, match='other parameters'):
+            call_command('benchmark', stdout=out, **{**options, 'size': 200})
+
+    def test_compare(self):
+        baseline = {'scenarios': {'list': {'queries': 2, 'median_ms': 10}, 'search': {'queries': 2, 'median_ms': 1}}}
+        results = {'scenarios': {'list': {'queries': 2, 'median_ms': 10.5}, 'search': {'queries': 2, 'median_ms': 2}}}
+        # slower by less than threshold or by less than MIN_DELTA_MS
+        assert benchmark.compare(results, baseline) == []
+
+        results['scenarios']['list']['median_ms'] = 15
+        assert benchmark.compare(results, baseline) == ['list: median 15.0ms instead of 10.0ms']
+        assert benchmark.compare(results, baseline, threshold=1) == []
+        assert benchmark.compare({'scenarios': {}}, baseline) == []
+
+
+class TestMetrics:
+    def test_server_timing(self, client, list_articles_url):
+        models.Article.objects.bulk_create_from_news_api(ARTICLES)
+        response = client.get(list_articles_url)
+        stages = [x.split(';')[0] for x in response['Server-Timing'].split(', ')]
+        assert stages == ['db', 'query', 'serialize', 'render', 'total']
+        assert 'desc="2 queries"' in response['Server-Timing']
+
+    def test_metrics(self, client, list_articles_url, news_api_stub, rf):
+        client.get(list_articles_url)
+        download_articles('test', 1)
+
+        # exposed only with METRICS_URL
+        with pytest.raises(NoReverseMatch):
+            reverse('metrics')
+        response = metrics.metrics(rf.get('/gateway/metrics/'))
+        assert response['Content-Type'].startswith('text/plain')
+        lines = response.content.decode().splitlines()
+        assert any(x.startswith('news_request_duration_seconds_bucket{view="articles-list",method="GET",status="200"')
+                   for x in lines)
+        assert any(x.startswith('news_stage_duration_seconds_count{stage="fetch"}') for x in lines)
+        assert any(x.startswith('news_request_db_queries_bucket{view="articles-list",le="2"}') for x in lines)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test', 'Test histogram', labels=('name',), buckets=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value, name='a "b"\n')
+        assert histogram.collect() == [
+            '# HELP test Test histogram',
+            '# TYPE test histogram',
+            'test_bucket{name="a \\"b\\"\\n",le="1"} 2',
+            'test_bucket{name="a \\"b\\"\\n",le="2"} 3',
+            'test_bucket{name="a \\"b\\"\\n",le="+Inf"} 4',
+            'test_sum{name="a \\"b\\"\\n"} 6.0',
+            'test_count{name="a \\"b\\"\\n"} 4',
+        ]
+
+        unlabelled = metrics.Histogram('plain', 'Histogram without labels', buckets=(1,))
+        unlabelled.observe(2)
+        assert unlabelled.collect()[-2:] == ['plain_sum 2', 'plain_count 1']
+
+    def test_slow_request_log(self, client, list_articles_url, settings, caplog):
+        settings.NEWS_SLOW_REQUEST_MS = 1e-6
+        client.get(list_articles_url)
+        assert 'SELECT' in caplog.text
+        assert list_articles_url in caplog.text
+
+
+@pytest.mark.django_db(transaction=True)
+class TestDatabaseRouting:
+    @pytest.fixture
+    def replicas(self, settings, monkeypatch):
+        settings.DATABASE_REPLICAS = ['replica_1', 'replica_2']
+        monkeypatch.setattr(db, '_local', threading.local())
+        monkeypatch.setattr(db, '_down', {})
+        reachable = {'replica_1', 'replica_2'}
+        monkeypatch.setattr(db, 'check_connection', lambda alias: alias in reachable)
+        return reachable
+
+    @staticmethod
+    def route(request, write=False):
+        """
+        :return tuple: databases of reads of the request (before and after its write) and the response
+        """
+        router = db.ReplicaRouter()
+        reads = []
+
+        def view(request):
+            reads.append(router.db_for_read(models.Article))
+            if write:
+                assert router.db_for_write(models.Article) == 'default'
+                reads.append(router.db_for_read(models.Article))
+            return HttpResponse()
+
+        return reads, db.RoutingMiddleware(view)(request)
+
+    def test_reads_of_safe_requests(self, rf, replicas):
+        reads, response = self.route(rf.get('/'))
+        assert reads[0] in replicas
+        assert db.PIN_COOKIE not in response.cookies
+        # the thread keeps its replica
+        assert self.route(rf.head('/'))[0] == reads
+
+        # out of requests and in transactions reads go to the primary
+        assert db.ReplicaRouter().db_for_read(models.Article) == 'default'
+        with transaction.atomic():
+            assert self.route(rf.get('/'))[0] == ['default']
+
+    def test_reads_after_write(self, rf, replicas, settings):
+        reads, response = self.route(rf.get('/'), write=True)
+        assert reads[0] in replicas
+        assert reads[1] == 'default'
+        assert response.cookies[db.PIN_COOKIE]['max-age'] == settings.DB_REPLICA_PIN_SECONDS
+
+        assert self.route(rf.post('/'))[0] == ['default']
+        rf.cookies[db.PIN_COOKIE] = '1'
+        assert self.route(rf.get('/'))[0] == ['default']
+
+    def test_unreachable_replicas(self, rf, replicas, monkeypatch):
+        replicas.discard('replica_1')
+        assert self.route(rf.get('/'))[0] == ['replica_2']
+
+        replicas.clear()
+        monkeypatch.setattr(db, '_local', threading.local())
+        assert self.route(rf.get('/'))[0] == ['default']
+        assert set(db._down) == {'replica_1', 'replica_2'}
+
+        # skipped until the retry
+        replicas.add('replica_1')
+        assert self.route(rf.get('/'))[0] == ['default']
+        db._down.clear()
+        assert self.route(rf.get('/'))[0] == ['replica_1']
+
+    def test_router_allows(self):
+        router = db.ReplicaRouter()
+        assert router.allow_migrate('default', 'news')
+        assert not router.allow_migrate('replica_1', 'news')
+        assert router.allow_relation(models.Article(), models.Author())
+
+    def test_broken_connections_closed(self, rf, monkeypatch):
+        default = connections['default']
+        default.ensure_connection()
+        monkeypatch.setattr(default, 'is_usable', lambda: False)
+        db.RoutingMiddleware(lambda request: HttpResponse())(rf.get('/'))
+        assert default.connection is None
+
+        # reconnected on check
+        assert db.check_connection('default')
+        assert default.connection is not None
+
+        def fail():
+            raise OperationalError('connection refused')
+
+        monkeypatch.setattr(default, 'ensure_connection', fail)
+        assert not db.check_connection('default')
@@ -1,28 +1,179 @@
-import requests
 import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+
+import pytz
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket: allows `rate` requests per second on average and bursts up to `capacity` requests
+    Thread-safe - one instance is meant to be shared by all threads using the same quota
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token, waits for it if the bucket is empty
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
 
 
 class NewsApi:
     DATE_FORMAT = '%Y-%m-%d'
     DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    FROM_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    URL = 'https://newsapi.org/v2/everything'
+    TIMEOUT = 10
+    RETRIES = 3
+    BACKOFF = 0.5
+    MAX_BACKOFF = 30
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    POOL_SIZE = 10
+    PAGE_SIZE = 100     # maximum of newsapi.org
+    MAXIMUM_RESULTS_REACHED = 'maximumResultsReached'
+
+    # one pool of keep-alive connections for the whole process
+    _session = None
+    _session_lock = threading.Lock()
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, url=None, timeout=None, retries=None, backoff=None, rate_limiter=None,
+                 page_size=None, max_pages=None):
+        """
+        :param timeout: seconds to wait for connection and for response
+        :param retries: number of retries of failed connection and of responses with RETRY_STATUSES
+        :param backoff: base of exponential delay between retries (seconds)
+        :param rate_limiter: RateLimiter shared by all clients of the same API key
+        :param page_size: number of articles requested per page
+        :param max_pages: maximal number of pages requested per query, None - no limit
+        """
         self.api_key = api_key
-        self.url = 'https://newsapi.org/v2/everything'
-
-    def get_articles(self, query, period=0):
-        from_date = datetime.datetime.now() - datetime.timedelta(days=period)
-        if isinstance(from_date, datetime.datetime):
-            from_date = from_date.strftime(self.DATE_FORMAT)
-
-        res = requests.get(self.url, params={
-            'q': query,
-            'from': from_date,
-            'apiKey': self.api_key
-        })
-        if not res.ok:
-            raise requests.HTTPError(res.content.decode())
-        res = res.json()
-        if 'articles' not in res:   # pragma: no cover
-            raise RuntimeError(f'Response from {self.url} does not contain "articles"')
-        return res['articles']
+        self.url = url or self.URL
+        self.timeout = self.TIMEOUT if timeout is None else timeout
+        self.retries = self.RETRIES if retries is None else retries
+        self.backoff = self.BACKOFF if backoff is None else backoff
+        self.rate_limiter = rate_limiter
+        self.page_size = page_size or self.PAGE_SIZE
+        self.max_pages = max_pages
+        self.session = self.get_session()
+
+    @classmethod
+    def get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=cls.POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls._session = session
+        return cls._session
+
+    def get_delay(self, attempt, response=None):
+        """
+        Exponential backoff with full jitter, but not shorter than Retry-After of the response
+        Neither is longer than MAX_BACKOFF - a large Retry-After would block the fetching thread
+        """
+        delay = random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+        if response is not None:
+            try:
+                delay = max(delay, min(self.MAX_BACKOFF, float(response.headers.get('Retry-After', 0))))
+            except ValueError:
+                pass
+        return delay
+
+    def request(self, params):
+        """
+        GET with retries of connection errors and of retryable statuses
+        :return dict: decoded response
+        """
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                res = self.session.get(self.url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                delay = self.get_delay(attempt)
+            else:
+                if res.ok:
+                    return res.json()
+                if res.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    raise requests.HTTPError(res.content.decode(), response=res)
+                delay = self.get_delay(attempt, res)
+            time.sleep(delay)
+
+    @classmethod
+    def parse_datetime(cls, value):
+        """
+        :return datetime: timezone aware datetime or None if value is not in DATETIME_FORMAT
+        """
+        try:
+            return pytz.utc.localize(datetime.datetime.strptime(value, cls.DATETIME_FORMAT))
+        except (TypeError, ValueError):
+            return None
+
+    def get_all_articles(self, query, period=0, from_time=None):
+        """
+        Pages through all results of the query
+
+        :param period: days in the past to get the articles from (by date)
+        :param from_time: exact datetime to get the articles from, overrides period
+        :return tuple: list of articles, True if all results were received
+        """
+        if from_time is not None:
+            from_date = from_time.astimezone(pytz.utc).strftime(self.FROM_DATETIME_FORMAT)
+        else:
+            from_date = (datetime.datetime.now() - datetime.timedelta(days=period)).strftime(self.DATE_FORMAT)
+
+        articles = []
+        for page in itertools.count(1):
+            try:
+                res = self.request(params={
+                    'q': query,
+                    'from': from_date,
+                    'sortBy': 'publishedAt',
+                    'page': page,
+                    'pageSize': self.page_size,
+                    'apiKey': self.api_key
+                })
+            except requests.HTTPError as e:
+                # plans of newsapi.org limit the number of results available by paging
+                if page > 1 and self.MAXIMUM_RESULTS_REACHED in str(e):
+                    logger.warning(f'Not all articles for "{query}" are available: {e}')
+                    return articles, False
+                raise
+            if 'articles' not in res:   # pragma: no cover
+                raise RuntimeError(f'Response from {self.url} does not contain "articles"')
+
+            articles += res['articles']
+            if len(res['articles']) < self.page_size or len(articles) >= res.get('totalResults', 0):
+                return articles, True
+            if self.max_pages and page >= self.max_pages:
+                return articles, False
+
+    def get_articles(self, query, period=0, from_time=None):
+        return self.get_all_articles(query, period, from_time)[0]
@@ -1,13 +1,24 @@
 import datetime
 import pytz
 
-from rest_framework import viewsets, filters
+from rest_framework import viewsets, filters, renderers
+from rest_framework import status
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.decorators import action
-from django.core.exceptions import ObjectDoesNotExist
-from news import serializers, models
-from news.management.commands.get_articles_from_newsapi import download_articles
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Count, F
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.utils import timezone
+from news import analyzer, images, serializers, models
+from news.cache import cache_response
+from news.filters import FullTextSearchFilter
+from news.metrics import timed
+from news.pagination import ArticlePagination
+from news.renderers import CSVRenderer, FastJSONRenderer, NDJSONRenderer
+from news import jobs
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
@@ -37,14 +48,33 @@ class ArticleViewSet(viewsets.ModelViewSet):
     date_verbose_format = 'YYYY-MM-DD'
     filter_fields = ('title', 'description', 'timestamp')
 
-    filter_backends = [filters.OrderingFilter, filters.SearchFilter]
+    pagination_class = ArticlePagination
+    filter_backends = [filters.OrderingFilter, FullTextSearchFilter]
     search_fields = ['title', 'description']
     ordering_fields = ['timestamp', 'author', 'title']
 
+    keywords_modes = ('all', 'any')
+    true_values = ('true', '1', 'yes')
+    # list is built from values() rows by ArticleRowSerializer, ArticleSerializer is used for the rest
+    fast_list = True
+    # actions reading articles - with sparse fieldsets of fields and omit parameters
+    sparse_actions = ('list', 'retrieve', 'related', 'export')
+    renderer_classes = [FastJSONRenderer, renderers.BrowsableAPIRenderer]
+
+    export_chunk_size = 2000
+
+    # periods of trending keywords
+    trending_periods = {
+        'hour': datetime.timedelta(hours=1),
+        'day': datetime.timedelta(days=1),
+        'week': datetime.timedelta(days=7),
+    }
+
     queryset = model.objects.all().order_by('-timestamp')
     _filter = {}
 
-    @swagger_auto_schema(manual_parameters=[
+    # parameters of get_queryset()
+    filter_parameters = [
         openapi.Parameter(
             'from_date', openapi.IN_QUERY,
             description=f"Start date (inclusive) for search query. Format: {date_verbose_format}",
@@ -54,10 +84,194 @@ class ArticleViewSet(viewsets.ModelViewSet):
             'to_date', openapi.IN_QUERY,
             description=f"End date (inclusive) for search query. Format: {date_verbose_format}",
             type=openapi.TYPE_STRING,
-        )
+        ),
+        openapi.Parameter(
+            'keywords', openapi.IN_QUERY,
+            description="Comma-separated keywords the articles must contain, in any form (watch - watches, watched)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            'keywords_mode', openapi.IN_QUERY,
+            description="'all' (default) - articles must contain all keywords, 'any' - at least one of them",
+            type=openapi.TYPE_STRING,
+            enum=list(keywords_modes),
+        ),
+        openapi.Parameter(
+            'collapse_duplicates', openapi.IN_QUERY,
+            description="true - only canonical articles, without their near-duplicates (the same story from other sources)",
+            type=openapi.TYPE_BOOLEAN,
+        ),
+    ]
+
+    # parameters of get_article_fields()
+    field_parameters = [
+        openapi.Parameter(
+            'fields', openapi.IN_QUERY,
+            description=f"Comma-separated fields of the articles to return, all by default: "
+                        f"{', '.join(serializers.ArticleRowSerializer.fields)}",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            'omit', openapi.IN_QUERY,
+            description="Comma-separated fields of the articles not to return",
+            type=openapi.TYPE_STRING,
+        ),
+    ]
+
+    @swagger_auto_schema(manual_parameters=filter_parameters + field_parameters + [
+        openapi.Parameter(
+            ArticlePagination.cursor_query_param, openapi.IN_QUERY,
+            description="Keyset pagination: empty for the first page, then follow `next` links. "
+                        "Ignores offset and supports only the default ordering",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            ArticlePagination.count_query_param, openapi.IN_QUERY,
+            description="How to get total count: 'exact' (default for offset pages), "
+                        "'estimate' - planner estimate, 'none' (default for cursor pages)",
+            type=openapi.TYPE_STRING,
+            enum=list(ArticlePagination.count_modes),
+        ),
     ])
+    @cache_response
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        if not self.fast_list:
+            return super().list(request, *args, **kwargs)
+
+        with timed('query'):
+            fields = self.get_article_fields()
+            queryset = self.filter_queryset(self.get_queryset()).values(
+                *serializers.ArticleRowSerializer.get_values(fields)
+            )
+            page = self.paginate_queryset(queryset)
+        if page is None:  # pragma: no cover
+            return Response(serializers.ArticleRowSerializer(fields).to_representation_many(queryset))
+        with timed('serialize'):
+            data = serializers.ArticleRowSerializer(fields).to_representation_many(page)
+        return self.get_paginated_response(data)
+
+    @swagger_auto_schema(manual_parameters=field_parameters)
+    @cache_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @swagger_auto_schema(method='get', manual_parameters=field_parameters + [
+        openapi.Parameter(
+            'limit', openapi.IN_QUERY,
+            description=f"Number of related articles, at most {settings.NEWS_RELATED_COUNT} (default)",
+            type=openapi.TYPE_INTEGER,
+        ),
+    ])
+    @action(detail=True, methods=['get'])
+    @cache_response
+    def related(self, request, pk, **kwargs):
+        """
+        Articles with the most common keywords ("more like this"), the most similar first
+        score is the sum of weights of the common keywords - the rarer keyword, the higher its weight
+        Related articles are precomputed, so it's one indexed lookup
+        """
+        try:
+            article_id = int(pk)
+            limit = int(request.GET.get('limit') or settings.NEWS_RELATED_COUNT)
+        except ValueError:
+            raise ValidationError('id and limit must be numeric')
+        if limit < 1:
+            raise ValidationError('limit must be positive')
+
+        fields = self.get_article_fields()
+        rows = self.model.objects.filter(related_to__article_id=article_id).order_by(
+            '-related_to__score', '-id'
+        ).values(*serializers.ArticleRowSerializer.get_values(fields), score=F('related_to__score'))[:limit]
+        serializer = serializers.ArticleRowSerializer(fields)
+        data = [dict(serializer.to_representation(row), score=row['score']) for row in rows]
+        if not data and not self.model.objects.filter(pk=article_id).exists():
+            raise NotFound('Article not found')
+        return Response(data)
+
+    @swagger_auto_schema(method='get', manual_parameters=[
+        openapi.Parameter(
+            'period', openapi.IN_QUERY,
+            description="Articles published in the last hour, day (default) or week",
+            type=openapi.TYPE_STRING,
+            enum=[*trending_periods],
+        ),
+        openapi.Parameter(
+            'limit', openapi.IN_QUERY,
+            description=f"Number of keywords, {settings.NEWS_TRENDING_COUNT} by default",
+            type=openapi.TYPE_INTEGER,
+        ),
+    ])
+    @action(detail=False, methods=['get'])
+    @cache_response
+    def trending(self, request, **kwargs):
+        """
+        Keywords of the most articles published in the period, the most frequent first
+        Articles are counted per keyword and hour on ingestion, so the period is rounded down to the hour
+        and the response does not depend on the number of articles
+        """
+        period = request.GET.get('period') or 'day'
+        if period not in self.trending_periods:
+            raise ValidationError(f"period must be one of: {', '.join(self.trending_periods)}")
+        try:
+            limit = int(request.GET.get('limit') or settings.NEWS_TRENDING_COUNT)
+        except ValueError:
+            raise ValidationError('limit must be numeric')
+        if limit < 1:
+            raise ValidationError('limit must be positive')
+
+        rows = models.KeywordTrend.objects.trending(timezone.now() - self.trending_periods[period])[:limit]
+        return Response([{'keyword': name, 'articles': articles} for name, articles in rows])
+
+    @swagger_auto_schema(method='get', manual_parameters=filter_parameters + field_parameters,
+                         responses={200: 'NDJSON or CSV'})
+    @action(detail=False, methods=['get'],
+            renderer_classes=[NDJSONRenderer, CSVRenderer, FastJSONRenderer])
+    def export(self, request, **kwargs):
+        """
+        Streams all articles matching the filters as NDJSON (one list item per line, default) or CSV
+        Format is chosen with Accept header or `format` parameter: ndjson, csv
+
+        Articles are read by server-side cursor in chunks, so memory use does not depend on the number of articles
+        """
+        fields = self.get_article_fields()
+        rows = self.get_queryset().order_by('-timestamp', '-id').values(
+            *serializers.ArticleRowSerializer.get_values(fields)
+        ).iterator(chunk_size=self.export_chunk_size)
+        articles = map(serializers.ArticleRowSerializer(fields).to_representation, rows)
+
+        if request.accepted_renderer.format == CSVRenderer.format:
+            renderer = CSVRenderer
+            content = CSVRenderer.stream(articles, serializers.ArticleRowSerializer.get_flat_fields(fields))
+        else:
+            renderer = NDJSONRenderer
+            content = NDJSONRenderer.stream(articles)
+        response = StreamingHttpResponse(content, content_type=renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="articles.{renderer.format}"'
+        return response
+
+    @swagger_auto_schema(method='get', responses={302: 'Redirect to the image'})
+    @action(detail=False, methods=['get'], url_path=r'images/(?P<content_hash>[0-9a-f]{64})/(?P<width>[0-9]+)')
+    def image(self, request, content_hash, width, **kwargs):
+        """
+        Derivative of the uploaded image of the given width, it's created on the first request
+        URLs of the derivatives are in image_srcset of the articles
+        """
+        width = int(width)
+        if width not in settings.NEWS_IMAGE_WIDTHS:
+            raise NotFound(f"Width must be one of: {', '.join(map(str, settings.NEWS_IMAGE_WIDTHS))}")
+
+        name = images.get_name(content_hash, width)
+        if not default_storage.exists(name):
+            article = self.model.objects.filter(image_hash=content_hash).exclude(image='').first()
+            if article is None:
+                raise NotFound('Image not found')
+            with article.image.open('rb') as file:
+                images.create_derivative(file, content_hash, width)
+
+        # content of the URL never changes - derivatives are keyed by hash of the original
+        response = HttpResponseRedirect(default_storage.url(name))
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
 
     @getter
     def _get_timestamp(self, value):
@@ -75,9 +289,44 @@ class ArticleViewSet(viewsets.ModelViewSet):
         if value:
             self._filter[parameter] = value
 
+    def get_article_fields(self):
+        """
+        Sparse fieldset of the articles: fields parameter (all fields by default) without the ones of omit parameter
+        :return tuple: names of the fields in the order of the representation
+        """
+        allowed = serializers.ArticleRowSerializer.fields
+        selected = [x for x in self._get_list('fields') or [] if x] or allowed
+        omitted = [x for x in self._get_list('omit') or [] if x]
+        unknown = [x for x in [*selected, *omitted] if x not in allowed]
+        if unknown:
+            raise ValidationError(f"Unknown fields: {', '.join(unknown)}. Expected: {', '.join(allowed)}")
+        fields = tuple(x for x in allowed if x in selected and x not in omitted)
+        if not fields:
+            raise ValidationError('No fields of the articles are selected')
+        return fields
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in self.sparse_actions:
+            kwargs.setdefault('fields', self.get_article_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def _select_fields(self, queryset):
+        """
+        Loads only the columns of the sparse fieldset into the articles, author is joined only for its field
+        """
+        fields = self.get_article_fields()
+        columns = serializers.ArticleRowSerializer.get_values(fields)
+        if 'author' in fields:
+            return queryset.select_related('author').only('author', *columns)
+        return queryset.only(*columns)
+
     def get_queryset(self):
         self._filter = {}
-        queryset = self.model.objects.all().order_by('-timestamp')
+        queryset = self.model.objects.order_by('-timestamp')
+        if self.action in self.sparse_actions:
+            queryset = self._select_fields(queryset)
+        else:
+            queryset = queryset.select_related('author')
 
         self._add_to_filter('timestamp__gte', self._get_timestamp('from_date'))
         to_date = self._get_timestamp('to_date')
@@ -87,16 +336,33 @@ class ArticleViewSet(viewsets.ModelViewSet):
 
         queryset = queryset.filter(**self._filter)
 
+        if self.request.GET.get('collapse_duplicates', '').lower() in self.true_values:
+            queryset = queryset.filter(canonical=None)
+
         keywords = self._get_list('keywords')
         if keywords:
-            for keyword in keywords:
-                try:
-                    k = models.Keyword.objects.get(name=keyword)
-                    queryset = queryset.filter(keywords=k)
-                except ObjectDoesNotExist:
-                    return self.model.objects.none()
+            queryset = self._filter_by_keywords(queryset, analyzer.analyze(*keywords))
         return queryset
 
+    def _filter_by_keywords(self, queryset, keywords):
+        """
+        Filters articles by keywords with a single subquery over the keyword links
+        Mode 'all' keeps articles linked to every keyword (GROUP BY article HAVING count = n),
+        mode 'any' - articles linked to at least one of them
+
+        :param keywords: terms of the keywords as they are indexed - no articles for none of them (e.g. stopwords)
+        """
+        mode = self.request.GET.get('keywords_mode') or self.keywords_modes[0]
+        if mode not in self.keywords_modes:
+            raise ValidationError(f"keywords_mode must be one of: {', '.join(self.keywords_modes)}")
+        if not keywords:
+            return queryset.none()
+
+        links = self.model.keywords.through.objects.filter(keyword__name__in=keywords)
+        if mode == 'all':
+            links = links.values('article_id').annotate(matched=Count('keyword_id')).filter(matched=len(keywords))
+        return queryset.filter(id__in=links.values('article_id'))
+
     @swagger_auto_schema(method='get', manual_parameters=[
         openapi.Parameter(
             'query', openapi.IN_QUERY,
@@ -109,12 +375,13 @@ class ArticleViewSet(viewsets.ModelViewSet):
             description="Period (from today) in the past to get the news",
             type=openapi.TYPE_INTEGER,
             required=True
-        )])
+        )], responses={202: serializers.IngestJobSerializer()})
     @action(detail=False, methods=['get'])
     def download_articles_from_newsapi(self, request, **kwargs):
         """
-        Call to this endpoint downloads articles from newsapi.org
-        Response payload holds new articles that were downloaded
+        Call to this endpoint starts download of articles from newsapi.org in background
+        Response payload holds the job - its status and new articles can be followed by its id.
+        Identical requests share one job while it's in progress
         """
         query = request.GET.get('query')
         if not query:
@@ -127,8 +394,18 @@ class ArticleViewSet(viewsets.ModelViewSet):
         except ValueError:
             raise ValidationError('period parameter must be numeric')
 
-        try:
-            new_articles = download_articles(query, period)
-            return Response(data=serializers.ArticleSerializer(new_articles, many=True).data)
-        except Exception as e:  # pragma: no cover
-            raise ValidationError(str(e))
+        job, created = models.IngestJob.objects.enqueue(query, period)
+        if created:
+            jobs.submit(job)
+            job.refresh_from_db()
+        return Response(data=serializers.IngestJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @swagger_auto_schema(method='get', responses={200: serializers.IngestJobSerializer()})
+    @action(detail=False, methods=['get'], url_path=r'download_articles_from_newsapi/(?P<job_id>[0-9]+)')
+    def download_job(self, request, job_id, **kwargs):
+        """
+        Status of the job started by download_articles_from_newsapi
+        Once it's done, new_article_ids holds ids of the articles that were downloaded
+        """
+        job = get_object_or_404(models.IngestJob.objects.all(), pk=job_id)
+        return Response(data=serializers.IngestJobSerializer(job).data)
@@ -43,7 +43,57 @@ ENVIRONMENT = os.getenv('ENVIRONMENT')
 
 NEWS_PORTAL_KEY = os.getenv('NEWS_PORTAL_KEY')
 
+# client of newsapi.org
+NEWS_API_URL = os.getenv('NEWS_API_URL', 'https://newsapi.org/v2/everything')
+NEWS_API_TIMEOUT = float(os.getenv('NEWS_API_TIMEOUT', 10))
+NEWS_API_RETRIES = int(os.getenv('NEWS_API_RETRIES', 3))
+# limit of pages requested per query, 0 - all pages
+NEWS_API_MAX_PAGES = int(os.getenv('NEWS_API_MAX_PAGES', 0)) or None
+# requests per second on average and maximal burst of requests
+NEWS_API_RATE_LIMIT = float(os.getenv('NEWS_API_RATE_LIMIT', 5))
+NEWS_API_RATE_BURST = int(os.getenv('NEWS_API_RATE_BURST', 10))
+
+# background ingestion jobs: threads per process, seconds without progress after which job is failed
+NEWS_INGEST_WORKERS = int(os.getenv('NEWS_INGEST_WORKERS', 2))
+NEWS_INGEST_JOB_TIMEOUT = int(os.getenv('NEWS_INGEST_JOB_TIMEOUT', 600))
+# run jobs synchronously in the request (tests, debugging)
+NEWS_INGEST_JOBS_EAGER = os.getenv('NEWS_INGEST_JOBS_EAGER') == 'TRUE'
+
+# widths (px) of derivatives of uploaded images, their format and quality
+NEWS_IMAGE_WIDTHS = [int(x) for x in os.getenv('NEWS_IMAGE_WIDTHS', '320,640,1280').split(',')]
+NEWS_IMAGE_FORMAT = os.getenv('NEWS_IMAGE_FORMAT', 'WEBP')
+NEWS_IMAGE_QUALITY = int(os.getenv('NEWS_IMAGE_QUALITY', 80))
+# derivatives are created on upload, otherwise - on the first request of each of them
+NEWS_IMAGE_EAGER = os.getenv('NEWS_IMAGE_EAGER', 'TRUE') == 'TRUE'
+# local copies of external images: downloaded after ingestion and served instead of the originals
+NEWS_IMAGE_CACHE = os.getenv('NEWS_IMAGE_CACHE', 'TRUE') == 'TRUE'
+NEWS_IMAGE_CACHE_WORKERS = int(os.getenv('NEWS_IMAGE_CACHE_WORKERS', 4))
+# downloads waiting for a worker, new ones are skipped over it (see cache_external_images command)
+NEWS_IMAGE_CACHE_QUEUE = int(os.getenv('NEWS_IMAGE_CACHE_QUEUE', 1000))
+NEWS_IMAGE_CACHE_TIMEOUT = float(os.getenv('NEWS_IMAGE_CACHE_TIMEOUT', 5))
+NEWS_IMAGE_CACHE_MAX_SIZE = int(os.getenv('NEWS_IMAGE_CACHE_MAX_SIZE', 10 * 1024 * 1024))
+# download in the ingesting thread (tests, debugging)
+NEWS_IMAGE_CACHE_EAGER = os.getenv('NEWS_IMAGE_CACHE_EAGER') == 'TRUE'
+
+# articles with this share of the same words published within the window (days) are the same story
+NEWS_DUPLICATE_SIMILARITY = float(os.getenv('NEWS_DUPLICATE_SIMILARITY', 0.85))
+NEWS_DUPLICATE_WINDOW_DAYS = int(os.getenv('NEWS_DUPLICATE_WINDOW_DAYS', 7))
+# number of precomputed related articles per article and keywords of more articles than this not relating them
+NEWS_RELATED_COUNT = int(os.getenv('NEWS_RELATED_COUNT', 10))
+NEWS_RELATED_MAX_KEYWORD_ARTICLES = int(os.getenv('NEWS_RELATED_MAX_KEYWORD_ARTICLES', 1000))
+# number of keywords in trending topics by default
+NEWS_TRENDING_COUNT = int(os.getenv('NEWS_TRENDING_COUNT', 10))
+# monthly partitions of articles created ahead, articles older than the retention (months, 0 - kept forever)
+# are moved to NDJSON archives in the directory
+NEWS_PARTITION_MONTHS_AHEAD = int(os.getenv('NEWS_PARTITION_MONTHS_AHEAD', 3))
+NEWS_RETENTION_MONTHS = int(os.getenv('NEWS_RETENTION_MONTHS', 0))
+NEWS_ARCHIVE_PATH = os.getenv('NEWS_ARCHIVE_PATH', os.path.join(BASE_DIR, 'archive'))
+
 ADMIN_URL = os.getenv('ADMIN_URL')
+# URL of metrics in Prometheus text format (e.g. metrics/), not set - metrics are not exposed
+METRICS_URL = os.getenv('METRICS_URL')
+# requests slower than this (milliseconds) are logged with their SQL queries, 0 - disabled
+NEWS_SLOW_REQUEST_MS = int(os.getenv('NEWS_SLOW_REQUEST_MS', 0))
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
@@ -56,6 +106,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'drf_yasg',
     'django_filters',
@@ -64,6 +115,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'news.db.RoutingMiddleware',
+    'news.metrics.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -107,9 +160,45 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', '123456'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        # seconds to keep connections between requests, 0 - a connection per request
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
     }
 }
 
+# read replicas: comma-separated host[:port] with the name and credentials of the primary,
+# reads of safe requests are spread over them (see news.db)
+DATABASE_REPLICAS = []
+for _number, _address in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), 1):
+    _host, _, _port = _address.strip().partition(':')
+    DATABASES[f'replica_{_number}'] = {
+        **DATABASES['default'],
+        'HOST': _host,
+        'PORT': _port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{_number}')
+DATABASE_ROUTERS = ['news.db.ReplicaRouter'] if DATABASE_REPLICAS else []
+# seconds a client reads from the primary after its write, seconds an unreachable replica is skipped
+DB_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 10))
+DB_REPLICA_RETRY_SECONDS = int(os.getenv('DB_REPLICA_RETRY_SECONDS', 30))
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# local memory by default, e.g. CACHE_BACKEND=django.core.cache.backends.memcached.PyMemcacheCache in production
+CACHE_BACKEND = os.getenv('CACHE_BACKEND')
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+# seconds to keep responses of article endpoints in cache, 0 disables it
+# Enabled by default only with a shared CACHE_BACKEND: writes of other processes (ingestion commands,
+# other workers) can't invalidate local memory of a web process
+NEWS_CACHE_TIMEOUT = int(os.getenv('NEWS_CACHE_TIMEOUT', 300 if CACHE_BACKEND else 0))
+
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
@@ -16,6 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
+from news.metrics import metrics
 
 _urlpatterns = [
     path('news/', include('news.urls'))
@@ -27,6 +28,11 @@ if settings.ADMIN_URL is not None:
         path(settings.ADMIN_URL, admin.site.urls),
     )
 
+if settings.METRICS_URL:
+    _urlpatterns.append(
+        path(settings.METRICS_URL, metrics, name='metrics'),
+    )
+
 urlpatterns = [
     path('gateway/', include(_urlpatterns))
 ]